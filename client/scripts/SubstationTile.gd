@@ -86,7 +86,8 @@ func has_safe_value(dict: Dictionary, key: String):
 var last_voltage: float = 0
 var last_data: Dictionary = {}
 func update_data(data: Dictionary):
-    last_data = data
+    # Packets may be deltas carrying only the changed fields, so merge rather than replace
+    last_data.merge(data, true)
     
     if has_safe_value(data, "name"):
         substation_label.clear()
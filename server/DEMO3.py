@@ -16,10 +16,14 @@ import calendar
 import numpy as np
 import matplotlib.pyplot as plt
 
+from drivers.database import MODBUS_COLUMNS
+from drivers.timeseries_cache import TimeSeriesCache
+
 plt.rcParams["font.family"] = ["Times New Roman", "serif"]
 plt.rcParams["font.size"] = 12
 
 DB_PATH = "../sensitive/modbus_data.db"
+TIMESERIES_CACHE_DIR = "./data/cache/timeseries"  # Set to None to keep loaded series in memory only
 
 
 def load_timeseries(
@@ -28,6 +32,7 @@ def load_timeseries(
     db_path: str = DB_PATH,
     start_date="2022-01-01 00:00:00",
     end_date="2025-02-25 10:30:00",
+    cache: TimeSeriesCache = None,
 ):
     valid_columns = {
         "id",
@@ -51,6 +56,10 @@ def load_timeseries(
     if column not in valid_columns:
         raise ValueError(f"Invalid column name: {column}")
 
+    if cache is not None and column in MODBUS_COLUMNS:
+        timestamps, values = cache.get(device_name, column, start_date, end_date)
+        return list(zip(pd.DatetimeIndex(timestamps.astype("datetime64[ns]")), values.tolist()))
+
     conn = sqlite3.connect(db_path)
     query = f"""
         SELECT timestamp, {column}
@@ -566,9 +575,11 @@ if __name__ == "__main__":
         # "102902",
     ]
 
+    cache = TimeSeriesCache(DB_PATH, cache_dir=TIMESERIES_CACHE_DIR)
+
     # run_all(subs_to_test, DB_PATH, EXPECTED_DELTA)
     for sub in subs_to_test:
-        data = load_timeseries(sub, "power_apparent", DB_PATH)
+        data = load_timeseries(sub, "power_apparent", DB_PATH, cache=cache)
 
         result = analyze_weekly_load(data, sub)
         if result["7d_autocorrelation"] < 0.6 and result["24h_autocorrelation"] < 0.6:
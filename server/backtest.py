@@ -0,0 +1,212 @@
+import copy
+import os
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+from dateutil.relativedelta import relativedelta
+
+from learn import (
+    LastDayReplayModel,
+    LastValueModel,
+    LastWeekReplayModel,
+    MovingAverageModel,
+    load_timeseries,
+    training_window_delta,
+)
+
+METRIC = "power_apparent"
+
+# Set in each worker process by _init_worker, so the series and models are sent once per worker
+# rather than once per task
+_series = None
+_models = None
+
+
+def rolling_origins(first_origin: datetime, last_origin: datetime, step: relativedelta):
+    """Forecast origins from first_origin to last_origin inclusive, step apart"""
+    origins = []
+    origin = first_origin
+    while origin <= last_origin:
+        origins.append(origin)
+        origin = origin + step
+    return origins
+
+
+def _init_worker(series, models):
+    global _series, _models
+    _series = series
+    _models = models
+
+
+def _between(series, start, end):
+    """The part of a time indexed series with start <= timestamp < end"""
+    return series[(series.index >= start) & (series.index < end)]
+
+
+def _evaluate(task):
+    """
+    Trains a fresh copy of one model on one split and returns its metrics and per step errors, or None
+    if the split has no data. Splits are half open, so the reading at the origin is only ever scored
+    and never trained on
+    """
+    sub, model_index, window, origin, outage_days = task
+    series = _series[sub]
+
+    training = _between(series, origin - training_window_delta(window), origin)
+    verification = _between(series, origin, origin + relativedelta(days=outage_days))
+    if training.empty or verification.empty:
+        return None
+
+    # A fresh copy every time, so results never depend on what the model saw in an earlier task
+    model = copy.deepcopy(_models[model_index])
+    model.train(training)
+    metrics = model.test(verification.to_frame())
+
+    steps = metrics["step_errors"]
+    return {
+        "substation": sub,
+        "model": model.name,
+        "training_window": window,
+        "origin": origin.isoformat(sep=" "),
+        "wmape_total": float(metrics["wmape_total"]),
+        "mae_total": float(metrics["mae_total"]),
+        "timestamp": steps["timestamp"].dt.strftime("%Y-%m-%d %H:%M:%S").to_numpy(),
+        "y_true": steps["y_true"].to_numpy(dtype=np.float32),
+        "y_pred": steps["y_pred"].to_numpy(dtype=np.float32),
+    }
+
+
+def _create_results_tables(conn):
+    conn.executescript(
+        """
+        CREATE TABLE IF NOT EXISTS backtest_summary (
+            substation TEXT NOT NULL,
+            model TEXT NOT NULL,
+            training_window TEXT NOT NULL,
+            origin TEXT NOT NULL,
+            wmape_total REAL,
+            mae_total REAL,
+            PRIMARY KEY (substation, model, training_window, origin)
+        );
+
+        -- One row per forecast step. Errors can be derived from y_true and y_pred so are not stored
+        CREATE TABLE IF NOT EXISTS backtest_steps (
+            substation TEXT NOT NULL,
+            model TEXT NOT NULL,
+            training_window TEXT NOT NULL,
+            origin TEXT NOT NULL,
+            step INTEGER NOT NULL,
+            timestamp TEXT NOT NULL,
+            y_true REAL,
+            y_pred REAL,
+            PRIMARY KEY (substation, model, training_window, origin, step)
+        ) WITHOUT ROWID;
+        """
+    )
+
+
+def _write_result(conn, result):
+    key = (result["substation"], result["model"], result["training_window"], result["origin"])
+    conn.execute(
+        "INSERT OR REPLACE INTO backtest_summary VALUES (?, ?, ?, ?, ?, ?)",
+        (*key, result["wmape_total"], result["mae_total"]),
+    )
+    # A rerun with a shorter horizon would otherwise leave the old run's later steps behind
+    conn.execute(
+        "DELETE FROM backtest_steps WHERE substation = ? AND model = ? AND training_window = ? AND origin = ?",
+        key,
+    )
+    conn.executemany(
+        "INSERT INTO backtest_steps VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        (
+            (*key, step, timestamp, None if np.isnan(y_true) else float(y_true), None if np.isnan(y_pred) else float(y_pred))
+            for step, (timestamp, y_true, y_pred) in enumerate(
+                zip(result["timestamp"], result["y_true"], result["y_pred"])
+            )
+        ),
+    )
+
+
+def walk_forward_backtest(
+    subs_to_test,
+    db_path,
+    models,
+    training_windows=("day", "week", "month", "year"),
+    first_origin=datetime(2024, 7, 2),
+    last_origin=datetime(2024, 10, 1),
+    origin_step=relativedelta(weeks=1),
+    outage_days=3,
+    results_path="./data/results/backtest.db",
+    max_workers=None,
+    cache=None,
+):
+    """
+    Rolling origin backtest of every model, training window and substation. Each forecast origin from
+    first_origin to last_origin, origin_step apart (by default weekly from 2024-07-02 to 2024-10-01),
+    gives a train split of the window before it and a verification split of outage_days from it. Each
+    substation's series is loaded from db_path once (through cache, a TimeSeriesCache, if given), and
+    the combinations run across a process pool with a fresh copy of the model each time.
+
+    Per step predictions go to the backtest_steps table of the SQLite database at results_path, with
+    one row per combination in backtest_summary. Returns the summary as a DataFrame
+    """
+    origins = rolling_origins(first_origin, last_origin, origin_step)
+
+    load_start = min(first_origin - training_window_delta(window) for window in training_windows)
+    load_end = last_origin + relativedelta(days=outage_days)
+
+    series = {
+        sub: load_timeseries(sub, METRIC, db_path, load_start, load_end, cache).iloc[:, 0] for sub in subs_to_test
+    }
+
+    tasks = [
+        (sub, model_index, window, origin, outage_days)
+        for sub in subs_to_test
+        for model_index in range(len(models))
+        for window in training_windows
+        for origin in origins
+    ]
+
+    os.makedirs(os.path.dirname(results_path) or ".", exist_ok=True)
+    conn = sqlite3.connect(results_path)
+    summary = []
+    try:
+        _create_results_tables(conn)
+        with ProcessPoolExecutor(max_workers, initializer=_init_worker, initargs=(series, models)) as pool:
+            for result in pool.map(_evaluate, tasks, chunksize=max(1, len(tasks) // (4 * (os.cpu_count() or 1)))):
+                if result is None:
+                    continue
+                _write_result(conn, result)
+                summary.append(
+                    {key: result[key] for key in ("substation", "model", "training_window", "origin", "wmape_total", "mae_total")}
+                )
+        conn.commit()
+    finally:
+        conn.close()
+
+    return pd.DataFrame(summary)
+
+
+if __name__ == "__main__":
+    models = [
+        LastValueModel(),
+        MovingAverageModel(window=4),
+        MovingAverageModel(window=96),
+        LastWeekReplayModel(),
+        LastDayReplayModel(),
+    ]
+
+    summary = walk_forward_backtest(
+        ["100800"],
+        "../sensitive/modbus_data.db",
+        models,
+        training_windows=["week", "month"],
+        first_origin=datetime(2024, 9, 1),
+        last_origin=datetime(2024, 10, 1),
+        outage_days=1,
+    )
+
+    print(summary.groupby(["model", "training_window"])["wmape_total"].describe())
@@ -0,0 +1,86 @@
+import asyncio
+import logging
+
+# Packets held per client before the oldest ones are dropped
+SUBSCRIBER_QUEUE_SIZE = 16
+
+DEFAULT_CHANNEL = "json"
+
+
+class Broadcaster:
+    """
+    Fans packets from a single producer out to any number of subscribers. Every subscriber gets its
+    own bounded queue; a client that falls behind loses its oldest packets rather than slowing the
+    producer or the other clients down. Publishing None tells subscribers the stream has ended.
+
+    Subscribers are grouped into channels, one per wire encoding, and the producer publishes to each
+    channel separately so every packet is only encoded once per encoding.
+
+    When a stream is stateful (deltas, or a schema sent up front) the producer also hands over a
+    keyframe callable for each tick. It is only evaluated when needed: new subscribers start from it,
+    and a subscriber that overflows has its backlog replaced by it so it never misses state it relies on.
+    """
+
+    def __init__(self, producer, queue_size: int = SUBSCRIBER_QUEUE_SIZE):
+        self.producer = producer
+        self.queue_size = queue_size
+        self.subscribers = {}
+        self._task = None
+        self._keyframes = {}
+        self._keyframe_packets = {}
+
+    def _current_keyframe(self, channel: str):
+        if self._keyframe_packets.get(channel) is None and self._keyframes.get(channel) is not None:
+            self._keyframe_packets[channel] = self._keyframes[channel]()
+        return self._keyframe_packets.get(channel)
+
+    def has_subscribers(self, channel: str = DEFAULT_CHANNEL) -> bool:
+        return bool(self.subscribers.get(channel))
+
+    def subscribe(self, channel: str = DEFAULT_CHANNEL) -> asyncio.Queue:
+        subscription = asyncio.Queue(maxsize=self.queue_size)
+        self.subscribers.setdefault(channel, set()).add(subscription)
+        logging.info(f"Client subscribed to {channel}, {len(self.subscribers[channel])} connected.")
+
+        # The producer is started lazily by the first subscriber. If it has since ended or failed, the
+        # next subscriber starts it again rather than being turned away
+        if self._task is None or self._task.done():
+            if self._task is not None:
+                logging.warning("Simulation producer is not running, restarting it")
+            self._keyframes.clear()
+            self._keyframe_packets.clear()
+            self._task = asyncio.create_task(self._run())
+        elif self._keyframes.get(channel) is not None:
+            subscription.put_nowait(self._current_keyframe(channel))
+
+        return subscription
+
+    def unsubscribe(self, subscription: asyncio.Queue, channel: str = DEFAULT_CHANNEL):
+        self.subscribers.get(channel, set()).discard(subscription)
+        logging.info(
+            f"Client unsubscribed from {channel}, {len(self.subscribers.get(channel, ()))} connected."
+        )
+
+    def publish(self, packet, keyframe=None, channel: str = DEFAULT_CHANNEL):
+        self._keyframes[channel] = keyframe
+        self._keyframe_packets[channel] = None
+
+        for subscription in self.subscribers.get(channel, ()):
+            if not subscription.full():
+                subscription.put_nowait(packet)
+            elif keyframe is None or packet is None:
+                subscription.get_nowait()
+                subscription.put_nowait(packet)
+            else:
+                while not subscription.empty():
+                    subscription.get_nowait()
+                subscription.put_nowait(self._current_keyframe(channel))
+
+    async def _run(self):
+        try:
+            await self.producer(self)
+        except Exception:
+            logging.exception("Simulation producer failed")
+        finally:
+            for channel in list(self.subscribers):
+                self.publish(None, channel=channel)
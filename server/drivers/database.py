@@ -1,12 +1,44 @@
 import sqlite3
 import logging
 import time
-from typing import Generator, List, Dict, Any
+import queue
+import threading
+import asyncio
+from dataclasses import dataclass
+from typing import Generator, List, Dict, Any, Iterable
+
+import numpy as np
+
+from .migrations import has_column
+
+# Readings are logged on a fixed 15 minute cadence
+INTERVAL = np.timedelta64(15 * 60, "s")
+
+MODBUS_COLUMNS = {
+    "current_a",
+    "current_b",
+    "current_c",
+    "power_active",
+    "power_reactive",
+    "power_apparent",
+    "power_factor",
+    "voltage_an",
+    "voltage_bn",
+    "voltage_cn",
+    "voltage_ab",
+    "voltage_bc",
+    "voltage_ca",
+    "cumulative_active_energy",
+}
 
 
 def fetch_reading_set(
-    db_path: str, start_time
+    db_path: str, start_time, streaming: bool = False
 ) -> Generator[List[Dict[str, Any]], None, None]:
+    if streaming:
+        yield from stream_reading_set(db_path, start_time)
+        return
+
     conn = sqlite3.connect(db_path)
     conn.row_factory = sqlite3.Row  # allows dict-like access
     cur = conn.cursor()
@@ -28,6 +60,279 @@ def fetch_reading_set(
     conn.close()
 
 
+def stream_reading_set(
+    db_path: str, start_time
+) -> Generator[List[Dict[str, Any]], None, None]:
+    """
+    Single pass variant of fetch_reading_set. Rather than collecting every timestamp up front and
+    issuing two queries per interval, this walks modbus_logs joined to site_totals in timestamp order
+    and groups rows as they arrive. Yields the same shape: one dict per substation reading with the
+    site totals dict appended last. Only the interval currently being assembled is held in memory.
+    """
+    conn = sqlite3.connect(db_path)
+    cur = conn.cursor()
+
+    # We need the column split between the two tables to unpack the joined rows
+    cur.execute("SELECT * FROM modbus_logs LIMIT 0")
+    log_columns = [col[0] for col in cur.description]
+    cur.execute("SELECT * FROM site_totals LIMIT 0")
+    total_columns = [col[0] for col in cur.description]
+    split = len(log_columns)
+    ts_index = log_columns.index("timestamp")
+
+    cur.execute(
+        """
+        SELECT m.*, s.*
+        FROM modbus_logs m
+        JOIN site_totals s ON s.timestamp = m.timestamp
+        WHERE m.timestamp >= ?
+        ORDER BY m.timestamp, m.device_name
+        """,
+        (start_time,),
+    )
+
+    current_ts = None
+    rows = []
+    site_totals = None
+
+    try:
+        for row in cur:
+            ts = row[ts_index]
+            if ts != current_ts:
+                if rows:
+                    rows.append(site_totals)
+                    yield rows
+                current_ts = ts
+                rows = []
+                site_totals = dict(zip(total_columns, row[split:]))
+
+            rows.append(dict(zip(log_columns, row[:split])))
+
+        if rows:
+            rows.append(site_totals)
+            yield rows
+    finally:
+        conn.close()
+
+
+class ReadAheadReader:
+    """
+    Runs fetch_reading_set on a worker thread and buffers up to `depth` upcoming reading sets
+    in a bounded queue, so database I/O overlaps with whatever the consumer is doing with the
+    current interval. Can be consumed with a plain for loop or, from a coroutine, with async for.
+    """
+
+    _DONE = object()
+
+    def __init__(self, db_path: str, start_time, depth: int = 8, streaming: bool = True):
+        self.db_path = db_path
+        self.start_time = start_time
+        self.streaming = streaming
+
+        self._queue = queue.Queue(maxsize=depth)
+        self._stop_event = threading.Event()
+        self._worker_thread = None
+
+    def start(self):
+        if self._worker_thread and self._worker_thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._worker_thread = threading.Thread(target=self._produce, daemon=True)
+        self._worker_thread.start()
+
+    def stop(self):
+        if not self._worker_thread:
+            return
+        self._stop_event.set()
+        # Unblock the producer if it is waiting on a full queue
+        try:
+            while True:
+                self._queue.get_nowait()
+        except queue.Empty:
+            pass
+        self._worker_thread.join(timeout=3)
+        self._worker_thread = None
+
+        # Release any consumer still waiting on the queue
+        try:
+            self._queue.put_nowait(self._DONE)
+        except queue.Full:
+            pass
+
+    def _put(self, item) -> bool:
+        while not self._stop_event.is_set():
+            try:
+                self._queue.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _produce(self):
+        try:
+            for reading_set in fetch_reading_set(
+                self.db_path, self.start_time, streaming=self.streaming
+            ):
+                if not self._put(reading_set):
+                    return
+        except Exception as err:
+            logging.error(f"Read-ahead worker failed: {err}")
+            self._put(err)
+            return
+        self._put(self._DONE)
+
+    def _unwrap(self, item):
+        if item is self._DONE:
+            self._stop_event.set()
+            raise StopIteration
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+    def __iter__(self):
+        self.start()
+        return self
+
+    def __next__(self):
+        return self._unwrap(self._queue.get())
+
+    def __aiter__(self):
+        self.start()
+        return self
+
+    async def __anext__(self):
+        try:
+            item = self._queue.get_nowait()
+        except queue.Empty:
+            # Wait for the producer without blocking the event loop
+            item = await asyncio.get_running_loop().run_in_executor(None, self._queue.get)
+
+        try:
+            return self._unwrap(item)
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+@dataclass
+class TimeWindow:
+    """
+    Dense block of readings on a regular 15 minute grid. Each entry in data is a
+    (timestamps x devices) float array with NaN wherever no reading was logged.
+    """
+
+    timestamps: np.ndarray
+    devices: List[str]
+    data: Dict[str, np.ndarray]
+
+    def series(self, device, column: str) -> np.ndarray:
+        """Returns a view of a single device's column, no copy is made"""
+        return self.data[column][:, self.devices.index(str(device))]
+
+    def slice(self, start, end) -> "TimeWindow":
+        """Returns a view of the window restricted to start <= t <= end"""
+        lo = np.searchsorted(self.timestamps, np.datetime64(start, "s"), side="left")
+        hi = np.searchsorted(self.timestamps, np.datetime64(end, "s"), side="right")
+        return TimeWindow(
+            self.timestamps[lo:hi],
+            self.devices,
+            {column: values[lo:hi] for column, values in self.data.items()},
+        )
+
+
+def read_readings(db_path: str, devices: Iterable, columns: Iterable[str], start_time, end_time):
+    """
+    Every logged row for the given devices with start_time <= timestamp <= end_time, in timestamp
+    order. Returns (timestamps, device names, {column: values}) as aligned arrays, timestamps as
+    datetime64[s] and values as floats with NaN for NULL readings
+    """
+    devices = [str(device) for device in devices]
+    columns = list(columns)
+    for column in columns:
+        if column not in MODBUS_COLUMNS:
+            raise ValueError(f"Invalid column name: {column}")
+
+    start = np.datetime64(start_time, "s")
+    end = np.datetime64(end_time, "s")
+
+    conn = sqlite3.connect(db_path)
+    placeholders = ", ".join("?" for _ in devices)
+
+    # Migrated databases carry an indexed integer epoch column, which saves both the
+    # string comparisons in the scan and the timestamp parsing afterwards
+    if has_column(conn, "modbus_logs", "epoch"):
+        time_column = "epoch"
+        bounds = (int(start.astype(np.int64)), int(end.astype(np.int64)))
+    else:
+        time_column = "timestamp"
+        bounds = (str(start).replace("T", " "), str(end).replace("T", " "))
+
+    rows = conn.execute(
+        f"""
+        SELECT {time_column}, device_name, {", ".join(columns)}
+        FROM modbus_logs
+        WHERE {time_column} >= ? AND {time_column} <= ?
+          AND device_name IN ({placeholders})
+        ORDER BY {time_column}
+        """,
+        (*bounds, *devices),
+    ).fetchall()
+    conn.close()
+
+    if not rows:
+        return (
+            np.empty(0, dtype="datetime64[s]"),
+            np.empty(0, dtype=object),
+            {column: np.empty(0) for column in columns},
+        )
+
+    row_ts, row_devices, *values = zip(*rows)
+
+    if time_column == "epoch":
+        row_ts = np.array(row_ts, dtype=np.int64).astype("datetime64[s]")
+    else:
+        row_ts = np.array(row_ts, dtype="datetime64[s]")
+
+    return (
+        row_ts,
+        np.array(row_devices, dtype=object),
+        {column: np.array(column_values, dtype=float) for column, column_values in zip(columns, values)},
+    )
+
+
+def load_time_window(
+    db_path: str, devices: Iterable, columns: Iterable[str], start_time, end_time
+) -> TimeWindow:
+    """
+    Pull a time range for many devices and columns out of modbus_logs in a single scan
+    and pack it into dense 15 minute aligned arrays. Timestamps that fall between grid
+    points are floored onto the preceding interval.
+    """
+    devices = [str(device) for device in devices]
+    columns = list(columns)
+
+    start = np.datetime64(start_time, "s")
+    end = np.datetime64(end_time, "s")
+    timestamps = np.arange(start, end + np.timedelta64(1, "s"), INTERVAL)
+
+    data = {
+        column: np.full((len(timestamps), len(devices)), np.nan)
+        for column in columns
+    }
+
+    row_ts, row_devices, values = read_readings(db_path, devices, columns, start, end)
+    if not len(row_ts):
+        return TimeWindow(timestamps, devices, data)
+
+    t_idx = (row_ts - start) // INTERVAL
+    device_lookup = {device: i for i, device in enumerate(devices)}
+    d_idx = np.fromiter((device_lookup[d] for d in row_devices), dtype=np.intp, count=len(row_ts))
+
+    for column in columns:
+        data[column][t_idx, d_idx] = values[column]
+
+    return TimeWindow(timestamps, devices, data)
+
+
 if __name__ == "__main__":
     for batch in fetch_reading_set("../sensitive/modbus_data.db"):
         print(batch)
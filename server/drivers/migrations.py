@@ -0,0 +1,94 @@
+import sqlite3
+import logging
+import sys
+
+DB_PATH = "../sensitive/modbus_data.db"
+
+# Each entry moves the database up one schema version. The version is tracked with
+# SQLite's user_version pragma so migrations can be re-run safely against any copy of
+# the database. Only ever append to this list, never edit an applied step.
+MIGRATIONS = [
+    (
+        "Index modbus_logs by (device_name, timestamp) for per-device range scans",
+        [
+            "CREATE INDEX IF NOT EXISTS idx_modbus_logs_device_timestamp ON modbus_logs (device_name, timestamp)",
+        ],
+    ),
+    (
+        "Index site_totals by timestamp",
+        [
+            "CREATE INDEX IF NOT EXISTS idx_site_totals_timestamp ON site_totals (timestamp)",
+        ],
+    ),
+    (
+        "Add integer epoch timestamps to modbus_logs",
+        [
+            "ALTER TABLE modbus_logs ADD COLUMN epoch INTEGER",
+            "UPDATE modbus_logs SET epoch = CAST(strftime('%s', timestamp) AS INTEGER)",
+            "CREATE INDEX IF NOT EXISTS idx_modbus_logs_epoch ON modbus_logs (epoch, device_name)",
+            # Keep the epoch column populated for rows written by the ingest scripts
+            """
+            CREATE TRIGGER IF NOT EXISTS trg_modbus_logs_epoch
+            AFTER INSERT ON modbus_logs
+            WHEN NEW.epoch IS NULL
+            BEGIN
+                UPDATE modbus_logs SET epoch = CAST(strftime('%s', NEW.timestamp) AS INTEGER)
+                WHERE id = NEW.id;
+            END
+            """,
+        ],
+    ),
+]
+
+
+def get_schema_version(conn: sqlite3.Connection) -> int:
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def has_column(conn: sqlite3.Connection, table: str, column: str) -> bool:
+    return any(row[1] == column for row in conn.execute(f"PRAGMA table_info({table})"))
+
+
+def migrate(db_path: str = DB_PATH, target_version: int = None) -> int:
+    """
+    Apply any outstanding migrations to the database at db_path, up to target_version
+    (or the latest known version). Each step runs in its own transaction. Returns the
+    resulting schema version.
+    """
+    if target_version is None:
+        target_version = len(MIGRATIONS)
+
+    conn = sqlite3.connect(db_path)
+    version = get_schema_version(conn)
+
+    if version > len(MIGRATIONS):
+        conn.close()
+        raise RuntimeError(
+            f"Database schema version {version} is newer than this tool supports ({len(MIGRATIONS)})"
+        )
+
+    while version < target_version:
+        description, statements = MIGRATIONS[version]
+        logging.info(f"Applying migration {version + 1}: {description}")
+        try:
+            conn.execute("BEGIN")
+            for statement in statements:
+                conn.execute(statement)
+            # PRAGMA does not accept bound parameters
+            conn.execute(f"PRAGMA user_version = {version + 1}")
+            conn.commit()
+        except sqlite3.Error as err:
+            conn.rollback()
+            conn.close()
+            raise RuntimeError(f"Migration {version + 1} failed: {err}")
+        version += 1
+
+    conn.execute("ANALYZE")
+    conn.close()
+    return version
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="[%(levelname)s]: %(message)s")
+    path = sys.argv[1] if len(sys.argv) > 1 else DB_PATH
+    print(f"Database at schema version {migrate(path)}")
@@ -0,0 +1,213 @@
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Tuple
+
+import numpy as np
+
+from .database import MODBUS_COLUMNS, read_readings
+
+# Record layout of the .npy files written to cache_dir
+RECORD_DTYPE = np.dtype([("timestamp", "datetime64[s]"), ("value", "f8")])
+
+
+def _to_seconds(value) -> np.datetime64:
+    return np.datetime64(value, "s")
+
+
+class TimeSeriesCache:
+    """
+    Memoises single device, single column reads from modbus_logs for the offline analysis scripts.
+    Entries are keyed on (device, column, start, end), and a request is answered from any loaded entry
+    whose range covers it. A request that only overlaps existing entries is loaded as one range
+    spanning all of them, and those entries are dropped. Entries are evicted least recently used first
+    once they hold more than max_bytes.
+
+    With a cache_dir, every range loaded from the database is also written there as a .npy file and read
+    back by later runs. Files are stored under the MAX(id) and row count of modbus_logs they were loaded
+    at, so they are ignored once rows are added or removed. The database is only checked for this when
+    the cache is first used and on refresh()
+    """
+
+    def __init__(self, db_path: str, max_bytes: int = 256 * 1024 * 1024, cache_dir: str = None):
+        self.db_path = db_path
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._version = None
+        self._lock = threading.Lock()
+
+    def _db_version(self) -> str:
+        conn = sqlite3.connect(self.db_path)
+        try:
+            max_id, row_count = conn.execute("SELECT MAX(id), COUNT(*) FROM modbus_logs").fetchone()
+        finally:
+            conn.close()
+        return f"{max_id}-{row_count}"
+
+    def _version_dir(self):
+        return os.path.join(self.cache_dir, self._version)
+
+    def _ensure_version(self):
+        if self._version is not None:
+            return
+        self._version = self._db_version()
+
+        if self.cache_dir:
+            os.makedirs(self._version_dir(), exist_ok=True)
+            # Files from any other version of the table can never be used again
+            for entry in os.listdir(self.cache_dir):
+                stale = os.path.join(self.cache_dir, entry)
+                if entry != self._version and os.path.isdir(stale):
+                    shutil.rmtree(stale, ignore_errors=True)
+
+    def refresh(self) -> bool:
+        """Drops everything cached if modbus_logs has changed since it was loaded. Returns True if it had"""
+        with self._lock:
+            if self._version is None:
+                return False
+            version = self._db_version()
+            if version == self._version:
+                return False
+
+            logging.info(f"modbus_logs changed ({self._version} -> {version}), clearing the time series cache")
+            self._entries.clear()
+            self._bytes = 0
+            self._version = None
+            self._ensure_version()
+            return True
+
+    def get(self, device, column: str, start, end) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns (timestamps, values) for a device's column with start <= timestamp <= end, in timestamp
+        order. Both arrays are copies the caller is free to modify
+        """
+        if column not in MODBUS_COLUMNS:
+            raise ValueError(f"Invalid column name: {column}")
+        device = str(device)
+        start = _to_seconds(start)
+        end = _to_seconds(end)
+
+        with self._lock:
+            self._ensure_version()
+
+            key = self._covering_entry(device, column, start, end)
+            if key is not None:
+                self.hits += 1
+                self._entries.move_to_end(key)
+            else:
+                self.misses += 1
+                key = self._load(device, column, start, end)
+
+            timestamps, values = self._entries[key]
+            lo = np.searchsorted(timestamps, start, side="left")
+            hi = np.searchsorted(timestamps, end, side="right")
+            return timestamps[lo:hi].copy(), values[lo:hi].copy()
+
+    def _covering_entry(self, device, column, start, end):
+        for key in reversed(self._entries):
+            entry_device, entry_column, entry_start, entry_end = key
+            if entry_device == device and entry_column == column and entry_start <= start and end <= entry_end:
+                return key
+        return None
+
+    def _load(self, device, column, start, end):
+        # Merge with anything this range overlaps, so repeated overlapping requests converge on one entry
+        overlapping = [
+            key
+            for key in self._entries
+            if key[0] == device and key[1] == column and key[2] <= end and start <= key[3]
+        ]
+        for key in overlapping:
+            start = min(start, key[2])
+            end = max(end, key[3])
+            self._discard(key)
+            if self.cache_dir:
+                try:
+                    os.remove(self._disk_path(key))
+                except FileNotFoundError:
+                    pass
+
+        key = (device, column, start, end)
+        records = self._read_disk(key)
+        if records is None:
+            records = self._query(device, column, start, end)
+            self._write_disk(key, records)
+
+        timestamps = records["timestamp"]
+        values = records["value"]
+        # Slices of these are handed out as copies, so make sure nothing writes to the cached arrays
+        timestamps.flags.writeable = False
+        values.flags.writeable = False
+
+        self._entries[key] = (timestamps, values)
+        self._bytes += timestamps.nbytes + values.nbytes
+        self._evict()
+        return key
+
+    def _query(self, device, column, start, end) -> np.ndarray:
+        row_ts, _, values = read_readings(self.db_path, [device], [column], start, end)
+
+        records = np.empty(len(row_ts), dtype=RECORD_DTYPE)
+        records["timestamp"] = row_ts
+        records["value"] = values[column]
+        return records
+
+    def _discard(self, key):
+        timestamps, values = self._entries.pop(key)
+        self._bytes -= timestamps.nbytes + values.nbytes
+
+    def _evict(self):
+        # Always keep the newest entry, even if it alone is over budget
+        while self._bytes > self.max_bytes and len(self._entries) > 1:
+            self._discard(next(iter(self._entries)))
+
+    def _disk_path(self, key):
+        device, column, start, end = key
+        return os.path.join(
+            self._version_dir(), f"{device}__{column}__{start.astype(np.int64)}__{end.astype(np.int64)}.npy"
+        )
+
+    def _read_disk(self, key):
+        if not self.cache_dir:
+            return None
+
+        device, column, start, end = key
+        prefix = f"{device}__{column}__"
+        for entry in os.listdir(self._version_dir()):
+            if not entry.startswith(prefix) or not entry.endswith(".npy"):
+                continue
+            try:
+                file_start, file_end = (np.datetime64(int(part), "s") for part in entry[len(prefix) : -4].split("__"))
+            except ValueError:
+                continue
+            if file_start > start or end > file_end:
+                continue
+
+            try:
+                records = np.load(os.path.join(self._version_dir(), entry))
+            except (OSError, ValueError) as err:
+                logging.warning(f"Ignoring unreadable time series cache file {entry}: {err}")
+                continue
+            lo = np.searchsorted(records["timestamp"], start, side="left")
+            hi = np.searchsorted(records["timestamp"], end, side="right")
+            return records[lo:hi].copy()
+
+        return None
+
+    def _write_disk(self, key, records):
+        if not self.cache_dir:
+            return
+        path = self._disk_path(key)
+        # Write then rename so a reader never sees a half written file
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "wb") as f:
+            np.save(f, records)
+        os.replace(temp_path, path)
@@ -5,11 +5,18 @@ from datetime import datetime, timedelta
 from dateutil.relativedelta import relativedelta
 import matplotlib.pyplot as plt
 
+from drivers.timeseries_cache import TimeSeriesCache
+
 plt.rcParams["font.family"] = ["Times New Roman", "serif"]
 plt.rcParams["font.size"] = 12
 
 
-def load_timeseries(substation, metric, db_path, start_date, end_date):
+def load_timeseries(substation, metric, db_path, start_date, end_date, cache: TimeSeriesCache = None):
+    if cache is not None:
+        timestamps, values = cache.get(substation, metric, start_date, end_date)
+        index = pd.DatetimeIndex(timestamps.astype("datetime64[ns]"), name="timestamp")
+        return pd.DataFrame({metric: values}, index=index)
+
     conn = sqlite3.connect(db_path)
     query = f"""
         SELECT timestamp, {metric}
@@ -52,6 +59,99 @@ def evaluate_baselines(df):
     return {"daily_wmape": daily_wmape, "weekly_wmape": weekly_wmape}
 
 
+def _lag_positions(index: pd.Index, timestamps: pd.DatetimeIndex, lag: pd.Timedelta) -> np.ndarray:
+    """Position in index of each timestamp minus lag, or -1 where there is no reading at that time"""
+    return index.get_indexer(timestamps - lag)
+
+
+def _recursive_lag_forecast(history: pd.Series, timestamps: pd.DatetimeIndex, lag: pd.Timedelta) -> pd.Series:
+    """
+    Replays history at a fixed lag, feeding each prediction back in as history for later timestamps,
+    without growing a Series one timestamp at a time. Reproduces the step by step replay exactly:
+
+    - a timestamp whose lagged time was predicted earlier in the run reuses that prediction
+    - otherwise one that lands on a history entry takes its value, even if that is NaN
+    - otherwise it repeats the most recent non NaN entry, counting predictions appended so far and
+      history entries overwritten by earlier predictions
+
+    Every prediction therefore points back at a history value or an earlier prediction. Those pointers
+    are resolved together by repeatedly following them, which takes log(n) vectorised steps. Which
+    entries are NaN depends on the resolved predictions, so with NaN in the history this is repeated
+    until that settles; each pass fixes at least the earliest wrong prediction, and it usually takes two
+    """
+    timestamps = pd.DatetimeIndex(timestamps)
+    values = history.to_numpy()
+    n_history, n = len(values), len(timestamps)
+    if n_history == 0:
+        raise ValueError("Cannot replay an empty history")
+
+    steps = np.arange(n)
+    history_nan = pd.isna(values)
+
+    # Earlier predictions for the lagged time take priority, since they overwrite or extend the history
+    earlier = _lag_positions(timestamps, timestamps, lag)
+    earlier_valid = (earlier >= 0) & (earlier < steps)
+    in_history = _lag_positions(history.index, timestamps, lag)
+
+    # Predictions for timestamps already in the history overwrite them in place rather than appending
+    overwrites = history.index.get_indexer(timestamps)
+    appended = overwrites < 0
+    overwritten_at = np.full(n_history, -1)
+    overwritten_at[overwrites[~appended]] = steps[~appended]
+    overwritten = np.flatnonzero(overwritten_at >= 0)
+
+    # The last history entry that stays non NaN for the whole run
+    static = ~history_nan
+    static[overwritten] = False
+    last_static = np.flatnonzero(static)[-1] if static.any() else -1
+
+    def resolve(prediction_nan):
+        # Most recent non NaN prediction appended before each step
+        usable = np.where(appended & ~prediction_nan, steps, -1)
+        last_appended = np.concatenate(([-1], np.maximum.accumulate(usable)[:-1]))
+
+        # Otherwise the last non NaN history entry, as it stands at that step
+        candidate = np.full(n, last_static)
+        fallback = np.full(n, last_static)
+        for position in overwritten:
+            step = overwritten_at[position]
+            replaced = steps > step
+            usable = np.where(replaced, ~prediction_nan[step], ~history_nan[position])
+            take = usable & (position > candidate)
+            candidate = np.where(take, position, candidate)
+            fallback = np.where(take, np.where(replaced, n_history + step, position), fallback)
+        fallback = np.where(last_appended >= 0, n_history + last_appended, fallback)
+
+        source = np.where(earlier_valid, n_history + earlier, np.where(in_history >= 0, in_history, fallback))
+
+        # A step with nothing to fall back on points at a NaN sentinel. It is only an error if that
+        # survives to the final pass, since earlier passes can be working from wrong NaN flags
+        pointers = np.arange(n_history + n + 1)
+        pointers[n_history : n_history + n] = np.where(source < 0, sentinel, source)
+        while True:
+            followed = pointers[pointers]
+            if np.array_equal(followed, pointers):
+                break
+            pointers = followed
+        return pointers[n_history : n_history + n]
+
+    sentinel = n_history + n
+    entry_nan = np.ones(n_history + n + 1, dtype=bool)
+    entry_nan[:n_history] = history_nan
+
+    prediction_nan = np.zeros(n, dtype=bool)
+    while True:
+        pointers = resolve(prediction_nan)
+        resolved_nan = entry_nan[pointers]
+        if np.array_equal(resolved_nan, prediction_nan):
+            break
+        prediction_nan = resolved_nan
+
+    if (pointers == sentinel).any():
+        raise ValueError("No non NaN value in the history to fall back on")
+    return pd.Series(values[pointers], index=timestamps)
+
+
 class BaseModel:
     def __init__(self, name):
         self.name = name
@@ -131,26 +231,44 @@ class SeasonalNaiveModel(BaseModel):
         if self.history is None or len(self.history) < self.season_lag:
             return pd.Series(self.history.dropna().iloc[-1], index=timestamps)
 
-        preds = []
-        for ts in timestamps:
-            lag_ts = ts - pd.Timedelta(minutes=15 * self.season_lag)
-            if lag_ts in self.history.index:
-                preds.append(self.history.loc[lag_ts])
-            else:
-                preds.append(self.history.dropna().iloc[-1])
+        positions = _lag_positions(self.history.index, timestamps, pd.Timedelta(minutes=15 * self.season_lag))
+        preds = self.history.to_numpy()[positions]
+
+        missing = positions < 0
+        if missing.any():
+            preds = np.where(missing, self.history.dropna().iloc[-1], preds)
         return pd.Series(preds, index=timestamps)
 
 
+TRAINING_WINDOWS = {
+    "day": relativedelta(days=1),
+    "week": relativedelta(weeks=1),
+    "month": relativedelta(months=1),
+    "year": relativedelta(years=1),
+}
+
+
+def training_window_delta(window):
+    if window not in TRAINING_WINDOWS:
+        raise ValueError(f"Unsupported window: {window}")
+    return TRAINING_WINDOWS[window]
+
+
 def specialised_accuracy_testing(
     subs_to_test,
     db_path,
     models,
     training_windows=["day", "week", "month", "year"],
     outage_days=3,
+    cache: TimeSeriesCache = None,
 ):
 
     results = []
 
+    # Every model reloads the same training and verification ranges, so only the first should hit the database
+    if cache is None:
+        cache = TimeSeriesCache(db_path)
+
     base_start = datetime(2023, 10, 1, 0, 0, 0)
     base_end = datetime(2024, 10, 1, 0, 0, 0)
 
@@ -158,27 +276,18 @@ def specialised_accuracy_testing(
         for model in models:
             for window in training_windows:
 
-                if window == "day":
-                    delta = relativedelta(days=1)
-                elif window == "week":
-                    delta = relativedelta(weeks=1)
-                elif window == "month":
-                    delta = relativedelta(months=1)
-                elif window == "year":
-                    delta = relativedelta(years=1)
-                else:
-                    raise ValueError(f"Unsupported window: {window}")
+                delta = training_window_delta(window)
 
                 train_end = base_end.replace(hour=0, minute=0, second=0)
                 train_start = train_end - delta
 
                 training_data = load_timeseries(
-                    sub, "power_apparent", db_path, train_start, train_end
+                    sub, "power_apparent", db_path, train_start, train_end, cache
                 )
 
                 verify_end = train_end + relativedelta(days=outage_days)
                 verification_data = load_timeseries(
-                    sub, "power_apparent", db_path, train_end, verify_end
+                    sub, "power_apparent", db_path, train_end, verify_end, cache
                 )
 
                 if training_data.empty or verification_data.empty:
@@ -214,23 +323,8 @@ class LastWeekReplayModel(BaseModel):
         if self.history is None:
             raise RuntimeError("Model not trained.")
 
-        preds = []
-        extended_history = self.history.copy()
-
-        for ts in timestamps:
-            lag_ts = ts - pd.Timedelta(weeks=1)
-
-            if lag_ts in extended_history.index:
-                # Use whatever we have for that timestamp (training or earlier prediction)
-                preds.append(extended_history.loc[lag_ts])
-            else:
-                # Fallback: use last known real value
-                preds.append(extended_history.dropna().iloc[-1])
-
-            # IMPORTANT: update extended history with this new prediction
-            extended_history.loc[ts] = preds[-1]
-
-        return pd.Series(preds, index=timestamps)
+        # Predictions are fed back in, so beyond a week out this replays its own earlier predictions
+        return _recursive_lag_forecast(self.history, timestamps, pd.Timedelta(weeks=1))
 
 
 class LastDayReplayModel(BaseModel):
@@ -246,22 +340,8 @@ class LastDayReplayModel(BaseModel):
         if self.history is None:
             raise RuntimeError("Model not trained.")
 
-        preds = []
-        extended_history = self.history.copy()
-
-        for ts in timestamps:
-            lag_ts = ts - pd.Timedelta(days=1)
-
-            if lag_ts in extended_history.index:
-                preds.append(extended_history.loc[lag_ts])
-            else:
-                # fallback: use last known real value from history
-                preds.append(extended_history.dropna().iloc[-1])
-
-            # update extended history with this new prediction
-            extended_history.loc[ts] = preds[-1]
-
-        return pd.Series(preds, index=timestamps)
+        # Predictions are fed back in, so beyond a day out this replays its own earlier predictions
+        return _recursive_lag_forecast(self.history, timestamps, pd.Timedelta(days=1))
 
 
 if __name__ == "__main__":
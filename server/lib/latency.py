@@ -0,0 +1,129 @@
+import json
+import logging
+import math
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+# Histogram resolution. Each power of two is split into this many log spaced buckets, so a reported
+# percentile is within about 9% of the true value
+BUCKETS_PER_DOUBLING = 8
+
+
+class LatencyHistogram:
+    """
+    Log bucketed histogram of durations in nanoseconds. Recording is O(1) and the memory used depends on
+    the spread of durations seen, not on how many were recorded, so it can sit on a hot path for the
+    life of the server
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.failures = 0
+        self.total_ns = 0
+        self.max_ns = 0
+        self._buckets = defaultdict(int)
+
+    def record(self, duration_ns: int, failed: bool = False):
+        self.count += 1
+        self.failures += failed
+        self.total_ns += duration_ns
+        self.max_ns = max(self.max_ns, duration_ns)
+        self._buckets[self._bucket(duration_ns)] += 1
+
+    @staticmethod
+    def _bucket(duration_ns: int) -> int:
+        return math.floor(math.log2(max(duration_ns, 1)) * BUCKETS_PER_DOUBLING)
+
+    def percentile(self, q: float) -> float:
+        """Upper edge of the bucket holding the q-th percentile (0-100), in nanoseconds"""
+        if not self.count:
+            return math.nan
+
+        rank = q / 100 * self.count
+        seen = 0
+        for bucket in sorted(self._buckets):
+            seen += self._buckets[bucket]
+            if seen >= rank:
+                return min(2 ** ((bucket + 1) / BUCKETS_PER_DOUBLING), self.max_ns)
+        return self.max_ns
+
+    def summary(self) -> dict:
+        """Counts plus total, mean and p50/p95/p99/max latency in milliseconds"""
+        ms = 1e-6
+        return {
+            "count": self.count,
+            "failures": self.failures,
+            "total_ms": self.total_ns * ms,
+            "mean_ms": self.total_ns * ms / self.count if self.count else math.nan,
+            "p50_ms": self.percentile(50) * ms,
+            "p95_ms": self.percentile(95) * ms,
+            "p99_ms": self.percentile(99) * ms,
+            "max_ms": self.max_ns * ms,
+        }
+
+    def buckets(self) -> dict:
+        """Count per bucket, keyed by the bucket's upper edge in nanoseconds"""
+        return {
+            round(2 ** ((bucket + 1) / BUCKETS_PER_DOUBLING)): count
+            for bucket, count in sorted(self._buckets.items())
+        }
+
+
+class StageTimer:
+    """
+    A LatencyHistogram per named stage of a repeating loop, fed by perf_counter_ns spans. Cheap enough
+    to leave on in the hot path; summaries can be logged at an interval or dumped to disk on request
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.dump_requested = False
+
+    def record(self, stage: str, duration_ns: int):
+        histogram = self.stages.get(stage)
+        if histogram is None:
+            histogram = self.stages[stage] = LatencyHistogram()
+        histogram.record(duration_ns)
+
+    @contextmanager
+    def span(self, stage: str):
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter_ns() - start)
+
+    def summary(self) -> dict:
+        # Stages can be recorded from more than one thread, so iterate over a copy
+        return {stage: histogram.summary() for stage, histogram in list(self.stages.items())}
+
+    def report(self):
+        for stage, summary in self.summary().items():
+            logging.info(
+                f"{stage:>18}: n={summary['count']} mean={summary['mean_ms']:.2f} ms "
+                f"p50={summary['p50_ms']:.2f} p95={summary['p95_ms']:.2f} p99={summary['p99_ms']:.2f} "
+                f"max={summary['max_ms']:.2f} ms"
+            )
+
+    def request_dump(self):
+        """Safe to call from a signal handler, the dump happens on the next maybe_dump()"""
+        self.dump_requested = True
+
+    def maybe_dump(self, path):
+        if not self.dump_requested:
+            return
+        self.dump_requested = False
+        self.dump(path)
+
+    def dump(self, path):
+        with open(path, "w") as f:
+            json.dump(
+                {
+                    stage: {"summary": histogram.summary(), "buckets_ns": histogram.buckets()}
+                    for stage, histogram in list(self.stages.items())
+                },
+                f,
+                indent=2,
+            )
+        logging.info(f"Tick stage latencies written to {path}")
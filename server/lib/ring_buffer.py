@@ -0,0 +1,80 @@
+from typing import Dict
+
+import numpy as np
+
+
+class RingBuffer:
+    """
+    Fixed capacity history backed by NumPy arrays, one per named field. Every entry is written twice,
+    at i and i + capacity, so the most recent n entries of a field are always a contiguous slice and
+    window() can hand out views without copying.
+
+    Indexing and iteration yield tuples of the fields in declaration order, oldest first, so code that
+    expects a list of (time, value) style tuples keeps working.
+    """
+
+    def __init__(self, capacity: int, fields: Dict[str, str]):
+        if capacity < 1:
+            raise ValueError(f"RingBuffer capacity must be at least 1, got {capacity}")
+
+        self.capacity = capacity
+        self.fields = dict(fields)
+        self._data = {name: np.empty(2 * capacity, dtype=dtype) for name, dtype in self.fields.items()}
+        self._head = 0
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def append(self, *values):
+        head = self._head
+        for array, value in zip(self._data.values(), values):
+            array[head] = value
+            array[head + self.capacity] = value
+
+        self._head = (head + 1) % self.capacity
+        self._size = min(self._size + 1, self.capacity)
+
+    def window(self, n: int = None, field: str = None) -> np.ndarray:
+        """
+        Read only view of the last n entries of a field (the last field by default), oldest first.
+        Returns fewer than n entries if the buffer does not hold that many yet
+        """
+        n = self._size if n is None else min(n, self._size)
+        array = self._data[field] if field else self._data[list(self._data)[-1]]
+
+        end = self._head + self.capacity
+        view = array[end - n : end]
+        view.flags.writeable = False
+        return view
+
+    def _entry(self, i: int) -> tuple:
+        index = self._head + self.capacity - self._size + i
+        return tuple(array[index].item() for array in self._data.values())
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [self._entry(i) for i in range(*key.indices(self._size))]
+
+        if key < 0:
+            key += self._size
+        if not 0 <= key < self._size:
+            raise IndexError("RingBuffer index out of range")
+        return self._entry(key)
+
+    def __iter__(self):
+        for i in range(self._size):
+            yield self._entry(i)
+
+    def resize(self, capacity: int) -> "RingBuffer":
+        """Returns a buffer with the new capacity holding as many of the most recent entries as fit"""
+        resized = RingBuffer(capacity, self.fields)
+        keep = min(self._size, capacity)
+        for name in self.fields:
+            values = self.window(keep, name)
+            resized._data[name][:keep] = values
+            resized._data[name][capacity : capacity + keep] = values
+
+        resized._head = keep % capacity
+        resized._size = keep
+        return resized
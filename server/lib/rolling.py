@@ -0,0 +1,89 @@
+from collections import deque
+from math import comb, isnan
+
+import numpy as np
+
+
+class RollingPolyfit:
+    """
+    Least squares polynomial fit over the last `window` values, extrapolated one step ahead. Rather than
+    refitting, it keeps the sums of x^k * y over the window (x = 0 for the oldest value) and shifts them
+    as values arrive, so updates and forecasts cost O(degree) whatever the window length. A degree of 0
+    is a moving average.
+
+    NaN readings count as zero in the sums and make the forecast NaN until they leave the window
+    """
+
+    def __init__(self, window: int, degree: int):
+        if window <= degree:
+            raise ValueError(f"A degree {degree} fit needs a window of more than {degree} values, got {window}")
+
+        self.window = window
+        self.degree = degree
+        self._values = deque(maxlen=window)
+        self._moments = [0.0] * (degree + 1)
+        self._nan_count = 0
+        self._shifts = 0
+
+        X = np.vander(np.arange(window), degree + 1, increasing=True)
+        next_x = np.vander([window], degree + 1, increasing=True)
+        # Maps the moments straight to the fitted value at x = window
+        self._weights = (next_x @ np.linalg.inv(X.T @ X))[0].tolist()
+        self._binomials = [[comb(k, j) * (-1) ** (k - j) for j in range(k + 1)] for k in range(degree + 1)]
+
+    def update(self, value: float):
+        y = 0.0 if isnan(value) else value
+        self._nan_count += isnan(value)
+
+        if len(self._values) < self.window:
+            x = len(self._values)
+            self._moments = [moment + x**k * y for k, moment in enumerate(self._moments)]
+            self._values.append(value)
+            return
+
+        dropped = self._values[0]
+        self._nan_count -= isnan(dropped)
+        self._values.append(value)
+
+        # Dropping the oldest value moves every other x down by one
+        moments = list(self._moments)
+        moments[0] -= 0.0 if isnan(dropped) else dropped
+        last_x = self.window - 1
+        self._moments = [
+            sum(c * moments[j] for j, c in enumerate(self._binomials[k])) + last_x**k * y
+            for k in range(self.degree + 1)
+        ]
+
+        # Rebuild the sums from the window now and then so rounding error cannot build up
+        self._shifts += 1
+        if self._shifts >= self.window:
+            self._shifts = 0
+            self._recompute()
+
+    def _recompute(self):
+        ys = [0.0 if isnan(v) else v for v in self._values]
+        self._moments = [sum(x**k * y for x, y in enumerate(ys)) for k in range(self.degree + 1)]
+
+    def forecast(self):
+        if len(self._values) < self.window:
+            return None
+        if self._nan_count:
+            return float("nan")
+        return sum(w * m for w, m in zip(self._weights, self._moments))
+
+
+class LaggedValue:
+    """The value observed `lag` updates ago, for last value and seasonal replay models"""
+
+    def __init__(self, lag: int):
+        self._values = deque(maxlen=lag)
+        self.count = 0
+
+    def update(self, value: float):
+        self._values.append(value)
+        self.count += 1
+
+    def forecast(self):
+        if len(self._values) < self._values.maxlen:
+            return None
+        return self._values[0]
@@ -61,98 +61,329 @@ import time
 from scipy.io import savemat
 import asyncio
 import websockets
+import queue
+import signal
 import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from lib.latency import StageTimer
 from plugin_host import PluginHost
+from radial_solver import RadialSweepSolver
+from broadcaster import Broadcaster
+from protocol import DeltaEncoder, BinaryEncoder, JSON_SUBPROTOCOL, BINARY_SUBPROTOCOL
 
 GLOBAL_SCALING_FACTOR = 5
 NETWORK_CONFIGURATION_DIRTY = False
-
-
-async def stream_modbus_logs(websocket):
-    host = PluginHost("plugins")
+READ_AHEAD_DEPTH = 8  # Number of upcoming reading sets buffered by the prefetch thread
+PREALLOCATE_LOADS = True  # Create loads once in build_network and update them in place each tick
+WARM_START = True  # Seed each solve from the previous interval's bus voltages
+NETWORK_CACHE_DIR = "./data/cache"  # Compiled networks, keyed by the contents of the config CSVs
+SOLVER_BACKEND = "pandapower"  # "pandapower" (Newton-Raphson) or "sweep" (radial backward/forward sweep)
+DELTA_ENCODING = True  # Only send fields that changed since the last packet, with periodic keyframes
+DELTA_EPSILON = 1e-3  # Smallest change in a numeric field that is worth sending
+KEYFRAME_INTERVAL = 96  # Ticks between full keyframes when delta encoding
+ISOLATE_MODELS = False  # Run MODEL plugins in worker processes so a slow or broken model cannot stall a tick
+MODEL_DEADLINE = 0.5  # Seconds per tick the isolated models have to answer before they count as missing
+STREAMING_MODELS = True  # Feed models with observe/forecast one reading at a time, False to use predict_batch
+REPORT_PLUGIN_STATS = False  # Include per-plugin call counts and latency percentiles in every packet
+STAGE_REPORT_INTERVAL = 96  # Ticks between logged per-stage latency summaries, 0 to only dump on SIGUSR1
+STAGE_DUMP_PATH = "./data/results/tick_stages.json"  # Where SIGUSR1 writes the per-stage histograms
+MEMORY_SAMPLE_INTERVAL = 0  # Trace allocations for one tick in every this many, 0 leaves tracemalloc off
+
+# Per-stage latency of the simulation tick and the websocket sends
+STAGE_TIMER = StageTimer()
+
+OFFLOAD_SIMULATION = True  # Run each tick on SIMULATION_EXECUTOR instead of blocking the event loop
+# One thread, so ticks never overlap and the network and nodes are only ever touched from it
+SIMULATION_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="simulation")
+
+# (tile id, config) pairs from client config_update messages, applied at the start of the next tick
+CONFIG_UPDATES = queue.Queue()
+
+
+async def run_simulation(broadcaster: Broadcaster):
+    """
+    The single simulation loop for the server. Replays the database, evaluates the models and the load
+    flow once per interval and publishes the serialised packet to every connected client.
+
+    With OFFLOAD_SIMULATION set, everything but the publishing runs on SIMULATION_EXECUTOR so the event
+    loop stays free to answer pings, accept connections and read client messages during a solve
+    """
+    loop = asyncio.get_running_loop()
+    host = PluginHost(
+        "plugins", isolate_models=ISOLATE_MODELS, model_deadline=MODEL_DEADLINE, streaming_models=STREAMING_MODELS
+    )
     host.start_watcher()
 
-
     try:
-        cable_types = load_cable_types("./data/config/cables.csv")
-        nodes = load_nodes_from_disk("./data/config/nodes.csv")
-        lines = load_lines_from_disk("./data/config/links.csv")
-
-        net, total_rating = build_network(nodes, lines, cable_types)
-
-        tracemalloc.start()
-        snapshot1 = tracemalloc.take_snapshot()
-        peaks = []
-
-        count = 0
-        try:
-            for reading_set in database.fetch_reading_set(
-                "../sensitive/modbus_data.db", "2024-10-01 04:45:00"
-            ):
-                
-                # Check for plugin changes on every server tick
+        compiled = load_compiled_network(
+            "./data/config/cables.csv",
+            "./data/config/nodes.csv",
+            "./data/config/links.csv",
+            NETWORK_CACHE_DIR,
+            preallocate_loads=PREALLOCATE_LOADS,
+        )
+        cable_types, nodes, lines = compiled.cable_types, compiled.nodes, compiled.lines
+        net, total_rating = compiled.net, compiled.total_rating
+        solver = create_solver(net)
+        result_mappings = (ResultMapping(lines), ResultMapping(nodes))
+
+        encoder = DeltaEncoder(DELTA_EPSILON, KEYFRAME_INTERVAL) if DELTA_ENCODING else None
+        binary_encoder = BinaryEncoder()
+
+        def simulate_tick(reading_set, count):
+            """
+            Runs one interval and returns the (packet, keyframe, channel) publications for it along with
+            the solve time. Touches no asyncio state, so it is safe to run off the event loop
+            """
+            nonlocal net, total_rating, solver
+
+            with STAGE_TIMER.span("config_updates"):
+                solver = apply_pending_config_updates(net, nodes, lines, solver)
+                total_rating = sum(node.rating for node in nodes.values())
+
+            # Tracing slows every allocation, so only do it for the occasional sampled tick
+            sample_memory = MEMORY_SAMPLE_INTERVAL and count % MEMORY_SAMPLE_INTERVAL == 0
+            if sample_memory:
+                tracemalloc.start()
+
+            # Check for plugin changes on every server tick
+            with STAGE_TIMER.span("plugin_events"):
                 host.process_plugin_events()
                 prediction_models = host.get_all_plugins('MODEL')
                 logging.info(f"Current Plugins: {prediction_models}")
 
-                # If the underlying configuration has changed, rebuild the whole network
-                # otherwise used the cached networks structure and simply drop the loads
-                if NETWORK_CONFIGURATION_DIRTY:
-                    net, total_rating = build_network(nodes, lines, cable_types)
-                else:
-                    clear_network_loads(net)
-
-                site_totals = reading_set.pop()  # TODO: Make this more resilient
-
-                exec_time = evaluate_load_flow_with_known_loads(
-                    nodes, lines, net, reading_set, site_totals, total_rating, prediction_models
+                # Grow the node histories to the longest lookback any loaded model needs. They never shrink
+                # here, so briefly unloading a long lookback model does not throw its history away
+                history_capacity = host.get_history_capacity()
+                for node in nodes.values():
+                    node.set_history_capacity(history_capacity)
+
+            # If the underlying configuration has changed, rebuild the whole network
+            # otherwise used the cached networks structure and simply drop the loads
+            if NETWORK_CONFIGURATION_DIRTY:
+                net, total_rating = build_network(
+                    nodes, lines, cable_types, preallocate_loads=PREALLOCATE_LOADS
                 )
+                solver = create_solver(net)
+            elif not PREALLOCATE_LOADS:
+                clear_network_loads(net)
 
-                if exec_time > 0.7:
-                    logger.warning(
-                        f"Main load flow evaluation time = {Fore.LIGHTRED_EX}{exec_time:.3f}{Fore.RESET} seconds."
-                    )
-                else:
-                    logger.notice(
-                        f"Main load flow evaluation time = {exec_time:.3f} seconds."
-                    )
+            site_totals = reading_set.pop()  # TODO: Make this more resilient
 
-                current, peak = tracemalloc.get_traced_memory()
-                peaks.append(current)
-                if len(peaks) == 100:
-                    print(f"Average: {sum(peaks)/100} MB")
-                print(
-                    f"Memory usage: {current/1024/1024:.1f} MB; Peak: {peak/1024/1024:.1f} MB"
+            exec_time, iterations = evaluate_load_flow_with_known_loads(
+                nodes,
+                lines,
+                net,
+                reading_set,
+                site_totals,
+                total_rating,
+                prediction_models,
+                solver,
+                result_mappings,
+                host,
+            )
+
+            if exec_time > 0.7:
+                logger.warning(
+                    f"Main load flow evaluation time = {Fore.LIGHTRED_EX}{exec_time:.3f}{Fore.RESET} seconds ({iterations} iterations)."
+                )
+            else:
+                logger.notice(
+                    f"Main load flow evaluation time = {exec_time:.3f} seconds ({iterations} iterations)."
                 )
 
+            publications = []
+            with STAGE_TIMER.span("serialisation"):
                 data = {}
 
                 data["line_data"] = serialise_list(list(lines.values()))
                 data["node_data"] = serialise_list(list(nodes.values()))
                 data["site_totals"] = site_totals
+                if REPORT_PLUGIN_STATS:
+                    data["plugin_stats"] = host.get_all_plugins(metadata=True)
+
+                if encoder:
+                    packet = json.dumps(encoder.encode(data), default=str)
+                    keyframe = lambda data=data: json.dumps(encoder.keyframe(data), default=str)
+                else:
+                    packet = json.dumps(data, default=str)
+                    keyframe = None
 
-                packet = json.dumps(data, default=str)
                 print(f"Preparing to send a packet with size: {len(packet)/1024:.1f} kB")
-                await websocket.send(packet)
+                publications.append((packet, keyframe, JSON_SUBPROTOCOL))
+
+                # Binary frames are only built while someone has negotiated them
+                if broadcaster.has_subscribers(BINARY_SUBPROTOCOL):
+                    schema_changed = binary_encoder.update_schema(data)
+                    frame = binary_encoder.encode(data)
+                    schema = binary_encoder.schema_packet()
+                    keyframe = lambda frame=frame, schema=schema: [schema, frame]
+                    publications.append((keyframe() if schema_changed else frame, keyframe, BINARY_SUBPROTOCOL))
+
+            if sample_memory:
+                current, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                logger.info(
+                    f"Sampled tick memory: {current/1024/1024:.1f} MB still allocated; Peak: {peak/1024/1024:.1f} MB"
+                )
+
+            return publications, exec_time
+
+        count = 0
+        reader = database.ReadAheadReader(
+            "../sensitive/modbus_data.db", "2024-10-01 04:45:00", depth=READ_AHEAD_DEPTH
+        )
+        try:
+            fetch_start = time.perf_counter_ns()
+            async for reading_set in reader:
+                tick_start = time.perf_counter_ns()
+                STAGE_TIMER.record("db_fetch", tick_start - fetch_start)
+
+                # One bad interval (a load flow that will not converge, a broken plugin) should cost that
+                # tick, not end the stream for every client
+                try:
+                    if OFFLOAD_SIMULATION:
+                        publications, exec_time = await loop.run_in_executor(
+                            SIMULATION_EXECUTOR, simulate_tick, reading_set, count
+                        )
+                    else:
+                        publications, exec_time = simulate_tick(reading_set, count)
+                except Exception:
+                    logger.exception(f"Simulation tick {count} failed, skipping it")
+                    publications, exec_time = [], 0
+
+                # The subscriber queues belong to the event loop, so publishing happens back here
+                for packet, keyframe, channel in publications:
+                    broadcaster.publish(packet, keyframe, channel=channel)
+
+                STAGE_TIMER.record("tick", time.perf_counter_ns() - tick_start)
+                if STAGE_REPORT_INTERVAL and (count + 1) % STAGE_REPORT_INTERVAL == 0:
+                    STAGE_TIMER.report()
+                STAGE_TIMER.maybe_dump(STAGE_DUMP_PATH)
 
                 if count < 7 * 96:
-                    count += 1
-                    continue
+                    # Still yield so the clients get a chance to drain their queues
+                    await asyncio.sleep(0)
                 else: await asyncio.sleep(max(0, 2 - exec_time))
+                count += 1
+                fetch_start = time.perf_counter_ns()
+
+        finally:
+            reader.stop()
+            if tracemalloc.is_tracing():
+                tracemalloc.stop()
+    finally:
+        host.stop_watcher()
+        host.stop_model_workers()
+
+
+BROADCASTER = Broadcaster(run_simulation)
+
+
+def apply_pending_config_updates(net, nodes, lines, solver):
+    """
+    Applies the queued client config updates to the running network in place and returns the solver
+    to use from now on. Model histories and the previous solution are kept, since line edits leave the
+    buses in place and a warm start that diverges falls back to a cold one anyway. Only a change in the
+    buses forces a cold start
+    """
+    bus_count = len(net.bus)
+    lines_changed = False
+    while True:
+        try:
+            tile_id, config = CONFIG_UPDATES.get_nowait()
+        except queue.Empty:
+            break
+
+        try:
+            lines_changed |= apply_config_update(net, nodes, lines, tile_id, config)
+            logger.info(f"Applied config update for id={tile_id}: {config}")
+        except (ValueError, TypeError, KeyError) as err:
+            logger.warning(f"Rejected config update for id={tile_id}: {err}")
+
+    if not lines_changed:
+        return solver
+
+    # Voltages solved for a different set of buses are no starting point
+    if len(net.bus) != bus_count:
+        invalidate_warm_start(net)
+
+    if solver is None:
+        # The sweep solver may have been dropped for an earlier topology it could not handle
+        return create_solver(net)
+    try:
+        solver.rebuild(keep_solution=len(net.bus) == bus_count)
+        return solver
+    except ValueError as err:
+        logger.warning(f"Radial solver unavailable after config update, falling back to pandapower: {err}")
+        return None
+
+
+async def receive_client_messages(websocket):
+    try:
+        async for message in websocket:
+            try:
+                payload = json.loads(message)
+            except json.JSONDecodeError:
+                payload = None
+            if not isinstance(payload, dict):
+                logger.warning(f"Ignoring malformed client message: {message!r}")
+                continue
+
+            if payload.get("action") == "config_update":
+                config = payload.get("config") or {}
+                if not isinstance(config, dict):
+                    logger.warning(f"Ignoring config_update with a non object config: {message!r}")
+                    continue
+                CONFIG_UPDATES.put((payload.get("id"), config))
+            else:
+                logger.warning(f"Ignoring unknown client action: {payload.get('action')}")
+    except websockets.exceptions.ConnectionClosed:
+        pass
+
+
+async def stream_modbus_logs(websocket):
+    # Clients that do not negotiate an encoding get JSON
+    channel = websocket.subprotocol or JSON_SUBPROTOCOL
+    subscription = BROADCASTER.subscribe(channel)
+    receiver = asyncio.create_task(receive_client_messages(websocket))
+    try:
+        while True:
+            packet = await subscription.get()
+            if packet is None:
+                break
+            send_start = time.perf_counter_ns()
+            if isinstance(packet, list):
+                for part in packet:
+                    await websocket.send(part)
+            else:
+                await websocket.send(packet)
+            STAGE_TIMER.record("websocket_send", time.perf_counter_ns() - send_start)
+    except websockets.exceptions.ConnectionClosed:
+        print("Client disconnected")
+    finally:
+        receiver.cancel()
+        BROADCASTER.unsubscribe(subscription, channel)
 
-        except websockets.exceptions.ConnectionClosed:
-            print("Client disconnected")
-        tracemalloc.stop()
-    except Exception as e:
-        print(e.with_traceback())
 
 # This is and gross function signature and should be refined if possible
 # feeding this many parameters is likely a bad sign on dependency flow
 def evaluate_load_flow_with_known_loads(
-    nodes, lines, net, reading_set, site_totals, total_rating, models
+    nodes,
+    lines,
+    net,
+    reading_set,
+    site_totals,
+    total_rating,
+    models,
+    solver=None,
+    result_mappings=(None, None),
+    host=None,
 ):
     remaining_rating = total_rating
+    load_values = {}
     loaded_subs = []
+    online_readings = []
     allocated_q = 0
     allocated_p = 0
     for i, reading in enumerate(reading_set):
@@ -172,30 +403,14 @@ def evaluate_load_flow_with_known_loads(
             reading["current_b"],
             reading["current_c"]
         ]
-
-        for model in models:
-            result = model.predict_next(NODE.raw_reading_history)
-            #print(f"{model}, {result}, {reading['power_apparent']}")
-
-            # Don't start scoring models until they are valid
-            if result is not None:
-                NODE.update_model_history(model.get_formatted_name(), result, reading["power_apparent"])
-            
-        NODE.add_raw_reading(site_totals['timestamp'], reading["power_apparent"])
+        online_readings.append((NODE, reading))
 
         loaded_subs.append(int(reading["device_name"]))
 
         allocated_p += p
         allocated_q += q
         remaining_rating -= NODE.rating
-        pp.create_load(
-            net,
-            NODE.node_object,
-            p_mw=p,
-            q_mvar=q,
-            scaling=GLOBAL_SCALING_FACTOR * NODE.load_scale_factor,
-            name=NODE.name,
-        )
+        load_values[NODE.id] = (p, q, GLOBAL_SCALING_FACTOR * NODE.load_scale_factor)
 
         NODE.is_online = True
 
@@ -203,6 +418,39 @@ def evaluate_load_flow_with_known_loads(
             f"Loaded {int(reading['device_name'])} with P={reading['power_active']/1000}, Q={reading['power_reactive']/1000}"
         )
 
+    prediction_start = time.perf_counter_ns()
+
+    # Each model runs once across every online node, before this interval's readings join the history
+    node_ids = [NODE.id for NODE, _ in online_readings]
+    histories = [NODE.raw_reading_history for NODE, _ in online_readings]
+    if host:
+        all_predictions = host.predict_all(models, node_ids, histories)
+    else:
+        all_predictions = [[model.predict_next(history) for history in histories] for model in models]
+
+    for model, predictions in zip(models, all_predictions):
+        model_name = model.get_formatted_name()
+
+        # A model that failed or ran out of time this tick is recorded as missing for every node
+        # it was already scoring
+        if predictions is None:
+            for NODE, reading in online_readings:
+                if model_name in NODE.model_prediction_history:
+                    NODE.update_model_history(model_name, None, reading["power_apparent"])
+            continue
+
+        for (NODE, reading), result in zip(online_readings, predictions):
+            # Don't start scoring models until they are valid
+            if result is not None:
+                NODE.update_model_history(model_name, result, reading["power_apparent"])
+
+    for NODE, reading in online_readings:
+        NODE.add_raw_reading(site_totals['timestamp'], reading["power_apparent"])
+        if host:
+            host.observe(models, NODE.id, NODE.raw_reading_history)
+
+    STAGE_TIMER.record("model_prediction", time.perf_counter_ns() - prediction_start)
+
     logger.info(f"Added {i+1} loads from timestamp: {site_totals['timestamp']}")
     logger.debug(f"Loaded: {loaded_subs}")
 
@@ -218,37 +466,107 @@ def evaluate_load_flow_with_known_loads(
         # The act of creating a load should invalidate the online status of a substation
         # We also skip the slack bus
         if id not in loaded_subs and id != 0:
-            pp.create_load(
-                net,
-                node.node_object,
-                p_mw=remaining_p * node.rating / remaining_rating,
-                q_mvar=remaining_q * node.rating / remaining_rating,
-                scaling=GLOBAL_SCALING_FACTOR * node.load_scale_factor,
-                name=node.name,
+            load_values[id] = (
+                remaining_p * node.rating / remaining_rating,
+                remaining_q * node.rating / remaining_rating,
+                GLOBAL_SCALING_FACTOR * node.load_scale_factor,
             )
             simulated_subs.append(id)
 
             node.is_online = False
     logger.info(f"Created {len(simulated_subs)} loads from site-wide scaling.")
     logger.debug(f"Loaded: {simulated_subs}")
+
+    # Networks built with preallocate_loads carry a load handle on every node
+    with STAGE_TIMER.span("load_creation"):
+        if all(nodes[id].load_object is not None for id in load_values):
+            update_network_loads(net, nodes, load_values)
+        else:
+            for id, (p, q, scaling) in load_values.items():
+                pp.create_load(
+                    net,
+                    nodes[id].node_object,
+                    p_mw=p,
+                    q_mvar=q,
+                    scaling=scaling,
+                    name=nodes[id].name,
+                )
     logger.notice(
         f"Processing load flow for timestamp: {Fore.LIGHTGREEN_EX}{site_totals['timestamp']}{Fore.RESET}"
     )
-    start = time.time()
-    pp.runpp(net)
-    stop = time.time()
+    start = time.perf_counter_ns()
+    iterations = solve_load_flow(net, warm_start=WARM_START, solver=solver)
+    solve_ns = time.perf_counter_ns() - start
+    STAGE_TIMER.record("solve", solve_ns)
 
-    update_lines_from_results(lines, net.res_line)
-    update_nodes_from_results(nodes, net.res_bus)
+    with STAGE_TIMER.span("result_extraction"):
+        line_mapping, node_mapping = result_mappings
+        update_lines_from_results(lines, net.res_line, line_mapping)
+        update_nodes_from_results(nodes, net.res_bus, node_mapping)
 
-    exec_time = stop - start
-    return exec_time
+    exec_time = solve_ns / 1e9
+    return exec_time, iterations
 
 
-async def main():
+def create_solver(net):
+    """
+    Returns the solver selected by SOLVER_BACKEND for this network, or None to use pandapower directly.
+    Falls back to pandapower if the network is not radial
+    """
+    if SOLVER_BACKEND != "sweep":
+        return None
+
+    try:
+        return RadialSweepSolver(net)
+    except ValueError as err:
+        logger.warning(f"Radial solver unavailable, falling back to pandapower: {err}")
+        return None
+
+
+def solve_load_flow(net, warm_start=False, solver=None):
+    """
+    Runs the load flow and returns the number of iterations it took. With warm_start set, the solve is
+    seeded from the previous converged result. A network that has never converged (freshly built, or
+    invalidated after a topology change) or a warm start that diverges falls back to a cold start
+    """
+    if solver is not None:
+        if warm_start and net.converged:
+            try:
+                return solver.solve(warm_start=True)
+            except pp.LoadflowNotConverged:
+                logger.warning("Warm started load flow did not converge, retrying from a cold start.")
+        return solver.solve()
+
+    if warm_start and net.converged:
+        try:
+            pp.runpp(net, init="results")
+            return net._ppc["iterations"]
+        except pp.LoadflowNotConverged:
+            logger.warning("Warm started load flow did not converge, retrying from a cold start.")
+
+    pp.runpp(net, init="auto")
+    return net._ppc["iterations"]
 
 
-    server = await websockets.serve(stream_modbus_logs, "127.0.0.1", 8080)
+def select_subprotocol(connection, subprotocols):
+    # Unlike the default negotiation, this still accepts clients that do not ask for any subprotocol
+    for protocol in (BINARY_SUBPROTOCOL, JSON_SUBPROTOCOL):
+        if protocol in subprotocols:
+            return protocol
+    return None
+
+
+async def main():
+    # kill -USR1 <pid> writes the per-stage latency histograms to STAGE_DUMP_PATH
+    if hasattr(signal, "SIGUSR1"):
+        asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, STAGE_TIMER.request_dump)
+
+    server = await websockets.serve(
+        stream_modbus_logs,
+        "127.0.0.1",
+        8080,
+        select_subprotocol=select_subprotocol,
+    )
     print("Server started on ws://127.0.0.1:8080")
     await server.wait_closed()
 
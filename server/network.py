@@ -1,7 +1,10 @@
 from dataclasses import dataclass
 from pathlib import Path
 import csv
+import hashlib
 import logging
+import os
+import pickle
 import pandapower as pp
 import pandas as pd
 from dataclasses import dataclass, field
@@ -15,6 +18,29 @@ import math
 
 from typing import List, Dict
 
+from lib.ring_buffer import RingBuffer
+
+# Bump whenever build_network, or the classes it links into the network, change what a compiled
+# network holds, so stale caches are not loaded
+NETWORK_CACHE_VERSION = 1
+
+# Entries kept per node until the loaded models report how much history they need. One week of
+# readings plus one, which covers LastWeekReplay
+DEFAULT_HISTORY_CAPACITY = 96 * 7 + 1
+
+READING_FIELDS = {"time": "datetime64[s]", "value": "float64"}
+PREDICTION_FIELDS = {"guess": "float64", "actual": "float64"}
+ERROR_FIELDS = {"abs_error": "float64", "actual": "float64"}
+
+# Recent accuracy reported alongside the all-time wMAPE when REPORT_RECENT_MODEL_PERF is set
+MODEL_PERF_WINDOW = 96  # Predictions covered by the rolling wMAPE (one day)
+MODEL_PERF_DECAY = 0.99  # Per tick weight applied to older errors in the decayed wMAPE
+REPORT_RECENT_MODEL_PERF = False
+
+
+def _nan_if_none(f):
+    return math.nan if f is None else f
+
 
 def string_to_bool(s):
     s = s.lower()
@@ -77,6 +103,10 @@ class Node:
         raise NotImplementedError()
 
 
+# Decimal places kept when results are serialised for the client
+RESULT_PRECISION = 5
+
+
 def assure_float(f: float):
     if f is None:
         return 0.0
@@ -84,6 +114,10 @@ def assure_float(f: float):
     return f
 
 
+def rounded(f: float):
+    return round(assure_float(f), RESULT_PRECISION)
+
+
 @dataclass
 class Line:
     id: int
@@ -113,8 +147,8 @@ class Line:
         _json["name"] = self.name
         _json["length"] = self.length
         _json["type"] = self.type
-        _json["loading"] = assure_float(self.loading_percent)
-        _json["i"] = assure_float(self.i_from_ka) * 1000
+        _json["loading"] = rounded(self.loading_percent)
+        _json["i"] = rounded(self.i_from_ka) * 1000
 
         return _json
 
@@ -149,6 +183,63 @@ class GilbertElliottSimulator:
         return lost
 
 
+class ModelErrorStats:
+    """
+    Running wMAPE sums for one model on one node, updated in O(1) per prediction. Alongside the all-time
+    figure it keeps a rolling window over the last `window` predictions and an exponentially decayed
+    variant, so recent accuracy can be shown without rescanning the prediction history
+    """
+
+    def __init__(self, window: int = MODEL_PERF_WINDOW, decay: float = MODEL_PERF_DECAY):
+        self.decay = decay
+
+        self.abs_error_sum = 0.0
+        self.actual_sum = 0.0
+
+        self._window = RingBuffer(window, ERROR_FIELDS)
+        self.window_abs_error_sum = 0.0
+        self.window_actual_sum = 0.0
+
+        self.decayed_abs_error_sum = 0.0
+        self.decayed_actual_sum = 0.0
+
+    def update(self, guess, actual):
+        if guess is None or actual is None or math.isnan(guess) or math.isnan(actual):
+            return
+
+        abs_error = abs(actual - guess)
+        abs_actual = abs(actual)
+
+        self.abs_error_sum += abs_error
+        self.actual_sum += abs_actual
+
+        if len(self._window) == self._window.capacity:
+            evicted_error, evicted_actual = self._window[0]
+            self.window_abs_error_sum -= evicted_error
+            self.window_actual_sum -= evicted_actual
+        self._window.append(abs_error, abs_actual)
+        self.window_abs_error_sum += abs_error
+        self.window_actual_sum += abs_actual
+
+        self.decayed_abs_error_sum = self.decayed_abs_error_sum * self.decay + abs_error
+        self.decayed_actual_sum = self.decayed_actual_sum * self.decay + abs_actual
+
+    @staticmethod
+    def _ratio(abs_error_sum, actual_sum):
+        if actual_sum > 0:
+            return abs_error_sum / actual_sum
+        return -1 # This may cause bugs, maybe use float('nan') in future??
+
+    def wmape(self):
+        return self._ratio(self.abs_error_sum, self.actual_sum)
+
+    def rolling_wmape(self):
+        return self._ratio(self.window_abs_error_sum, self.window_actual_sum)
+
+    def decayed_wmape(self):
+        return self._ratio(self.decayed_abs_error_sum, self.decayed_actual_sum)
+
+
 @dataclass
 class ActiveNode:
     id: int
@@ -159,6 +250,7 @@ class ActiveNode:
     is_transformer_node: bool = True
     node_mv_nominal: float = 11.0
     node_object: Optional[object] = None
+    load_object: Optional[object] = None
     comment: str = ""
 
     is_online: bool = False
@@ -172,36 +264,48 @@ class ActiveNode:
     gilbert_elliott_simulator: Optional[object] = None
 
     valid_readings: list = field(default_factory=list)
-    raw_reading_history: list = field(default_factory=list)
-    model_prediction_history: list = field(default_factory=list)
+    raw_reading_history: RingBuffer = field(
+        default_factory=lambda: RingBuffer(DEFAULT_HISTORY_CAPACITY, READING_FIELDS)
+    )
+    # Model name -> RingBuffer of (guess, actual)
+    model_prediction_history: dict = field(default_factory=dict)
+    # Model name -> ModelErrorStats
+    model_error_stats: dict = field(default_factory=dict)
 
     def add_raw_reading(self, time, s):
-        self.raw_reading_history.append((time, s))
+        self.raw_reading_history.append(np.datetime64(time, "s"), _nan_if_none(s))
 
     def update_model_history(self, model, guess, actual):
-        self.model_prediction_history.append((model, guess, actual))
+        if model not in self.model_prediction_history:
+            self.model_prediction_history[model] = RingBuffer(
+                self.raw_reading_history.capacity, PREDICTION_FIELDS
+            )
+        self.model_prediction_history[model].append(_nan_if_none(guess), _nan_if_none(actual))
+
+        if model not in self.model_error_stats:
+            self.model_error_stats[model] = ModelErrorStats()
+        self.model_error_stats[model].update(guess, actual)
+
+    def set_history_capacity(self, capacity: int, shrink: bool = False):
+        """
+        Resizes every history buffer, keeping the most recent entries. Buffers only grow unless shrink is
+        set, since history dropped by a shrink cannot be recovered if a model needing it comes back
+        """
+        current = self.raw_reading_history.capacity
+        if capacity == current or (capacity < current and not shrink):
+            return
+        self.raw_reading_history = self.raw_reading_history.resize(capacity)
+        for model, history in self.model_prediction_history.items():
+            self.model_prediction_history[model] = history.resize(capacity)
 
     def compute_wmape_per_model(self):
-        grouped = defaultdict(list)
-        for model, guess, actual in self.model_prediction_history:
-            grouped[model].append((guess, actual))
-
-        results = {}
-        for model, pairs in grouped.items():
-            abs_error_sum = 0.0
-            actual_sum = 0.0
-            for guess, actual in pairs:
-                if math.isnan(actual) or math.isnan(guess):
-                    continue
-                abs_error_sum += abs(actual - guess)
-                actual_sum += abs(actual)
-            if actual_sum > 0:
-                results[model] = abs_error_sum / actual_sum
-            else:
-                results[model] = -1 # This may cause bugs, maybe use float('nan') in future??
-
-        return results
-    
+        return {model: stats.wmape() for model, stats in self.model_error_stats.items()}
+
+    def compute_recent_wmape_per_model(self):
+        return {
+            model: {"rolling": stats.rolling_wmape(), "decayed": stats.decayed_wmape()}
+            for model, stats in self.model_error_stats.items()
+        }
 
     def serialise(self):
         _json = {}
@@ -209,13 +313,15 @@ class ActiveNode:
         _json["id"] = str(self.id)
         _json["name"] = self.name
         _json["rating"] = assure_float(self.rating)
-        _json["voltage"] = assure_float(self.vm_pu) * self.node_mv_nominal
-        _json["p_kw"] = assure_float(self.p_mw) * 1000
-        _json["q_kvar"] = assure_float(self.q_mvar) * 1000
-        _json["phase"] = assure_float(self.va_degree)
+        _json["voltage"] = rounded(self.vm_pu) * self.node_mv_nominal
+        _json["p_kw"] = rounded(self.p_mw) * 1000
+        _json["q_kvar"] = rounded(self.q_mvar) * 1000
+        _json["phase"] = rounded(self.va_degree)
         _json["online"] = self.is_online
 
         _json["model_perf"] = self.compute_wmape_per_model()
+        if REPORT_RECENT_MODEL_PERF:
+            _json["model_perf_recent"] = self.compute_recent_wmape_per_model()
 
         if self.phase_data:
             _json["av"] = self.phase_data[0]
@@ -245,29 +351,63 @@ class ActiveNode:
         self.valid_readings.append((p, q))
 
 
-def update_nodes_from_results(nodes: Dict[int, ActiveNode], res_bus) -> None:
-    for id, node in nodes.items():
-        if id in res_bus.index:
-            row = res_bus.loc[id]
-            node.vm_pu = round(float(row["vm_pu"]), 5)
-            node.va_degree = round(float(row["va_degree"]), 5)
-            node.p_mw = round(float(row["p_mw"]), 5)
-            node.q_mvar = round(float(row["q_mvar"]), 5)
+NODE_RESULT_FIELDS = ["vm_pu", "va_degree", "p_mw", "q_mvar"]
+LINE_RESULT_FIELDS = [
+    "loading_percent",
+    "i_from_ka",
+    "i_to_ka",
+    "p_from_mw",
+    "q_from_mvar",
+    "p_to_mw",
+    "q_to_mvar",
+    "pl_mw",
+    "ql_mvar",
+]
 
 
-def update_lines_from_results(lines: Dict[int, Line], res_line) -> None:
-    for id, line in lines.items():
-        if id in res_line.index:
-            row = res_line.loc[id]
-            line.loading_percent = round(float(row["loading_percent"]), 5)
-            line.i_from_ka = round(float(row["i_from_ka"]), 5)
-            line.i_to_ka = round(float(row["i_to_ka"]), 5)
-            line.p_from_mw = round(float(row["p_from_mw"]), 5)
-            line.q_from_mvar = round(float(row["q_from_mvar"]), 5)
-            line.p_to_mw = round(float(row["p_to_mw"]), 5)
-            line.q_to_mvar = round(float(row["q_to_mvar"]), 5)
-            line.pl_mw = round(float(row["pl_mw"]), 5)
-            line.ql_mvar = round(float(row["ql_mvar"]), 5)
+class ResultMapping:
+    """
+    Precomputed positions of a set of nodes or lines within a pandapower result table. The positions
+    are only recalculated when the result table index changes, which in practice means after a rebuild
+    """
+
+    def __init__(self, items: Dict[int, object]):
+        self.ids = list(items.keys())
+        self.items = list(items.values())
+        self._index = None
+        self._positions = None
+        self._targets = None
+
+    def resolve(self, res_index):
+        if self._index is None or not res_index.equals(self._index):
+            positions = res_index.get_indexer(self.ids)
+            present = positions >= 0
+            self._positions = positions[present]
+            self._targets = [item for item, found in zip(self.items, present) if found]
+            self._index = res_index
+        return self._positions, self._targets
+
+
+def _apply_results(mapping: ResultMapping, results, fields: List[str]) -> None:
+    positions, targets = mapping.resolve(results.index)
+
+    # One array pull per column, then plain python floats for the attribute writes
+    columns = [results[field].to_numpy(dtype=float)[positions].tolist() for field in fields]
+    for target, values in zip(targets, zip(*columns)):
+        for field, value in zip(fields, values):
+            setattr(target, field, value)
+
+
+def update_nodes_from_results(
+    nodes: Dict[int, ActiveNode], res_bus, mapping: ResultMapping = None
+) -> None:
+    _apply_results(mapping or ResultMapping(nodes), res_bus, NODE_RESULT_FIELDS)
+
+
+def update_lines_from_results(
+    lines: Dict[int, Line], res_line, mapping: ResultMapping = None
+) -> None:
+    _apply_results(mapping or ResultMapping(lines), res_line, LINE_RESULT_FIELDS)
 
 
 def load_nodes_from_disk(node_file: Path) -> Dict[int, ActiveNode]:
@@ -331,11 +471,17 @@ def load_lines_from_disk(line_file: Path) -> Dict[int, Line]:
 
 
 def build_network(
-    nodes: Dict[int, ActiveNode], lines: Dict[int, Line], cable_types: List[LineType]
+    nodes: Dict[int, ActiveNode],
+    lines: Dict[int, Line],
+    cable_types: List[LineType],
+    preallocate_loads: bool = False,
 ):
     """
     Construct a pandapower network from the specified nodes and lines. Warning: This function mutates
     the state of the nodes and lines by linking them to the pandapower network elements
+
+    With preallocate_loads set, one load is created per node (excluding the slack bus) up front so that
+    each tick can write its values in place with update_network_loads rather than recreating them
     """
     net = pp.create_empty_network()
 
@@ -367,6 +513,7 @@ def build_network(
             net, vn_kv=node.node_mv_nominal, name=node.name, index=id
         )
         node.node_object = pp_bus
+        node.load_object = None
 
         total_rating += node.rating
 
@@ -380,6 +527,14 @@ def build_network(
     # Now that it has been created, attach the slack bus to the external grid
     pp.create_ext_grid(net, nodes[0].node_object)
 
+    if preallocate_loads:
+        for id, node in nodes.items():
+            if id == 0:
+                continue
+            node.load_object = pp.create_load(
+                net, node.node_object, p_mw=0.0, q_mvar=0.0, name=node.name
+            )
+
     for id, line in lines.items():
 
         node_from = None
@@ -416,3 +571,175 @@ def clear_network_loads(net: pd.DataFrame):
     Helper function which clears all load definitions from a pandapower network
     """
     net.load.drop(net.load.index, inplace=True)
+
+
+def update_network_loads(net, nodes: Dict[int, ActiveNode], load_values: Dict[int, tuple]):
+    """
+    Writes (p_mw, q_mvar, scaling) for each node into the loads created by build_network with
+    preallocate_loads=True. This is a single vectorised assignment and leaves the network structure untouched
+    """
+    ids = list(load_values.keys())
+    index = [nodes[id].load_object for id in ids]
+    values = np.array([load_values[id] for id in ids], dtype=float)
+
+    net.load.loc[index, ["p_mw", "q_mvar", "scaling"]] = values
+
+
+def invalidate_warm_start(net):
+    """
+    Marks the previous solution as unusable so the next solve starts cold. Call this after any
+    change to the network topology
+    """
+    net.converged = False
+
+
+@dataclass
+class CompiledNetwork:
+    cable_types: List[LineType]
+    nodes: Dict[int, ActiveNode]
+    lines: Dict[int, Line]
+    net: object
+    total_rating: float
+
+
+def _network_inputs_hash(input_files, preallocate_loads: bool) -> str:
+    sha = hashlib.sha256(f"{NETWORK_CACHE_VERSION}:{preallocate_loads}".encode())
+    for path in input_files:
+        with open(path, "rb") as f:
+            sha.update(f.read())
+    return sha.hexdigest()
+
+
+def load_compiled_network(
+    cable_file: Path,
+    node_file: Path,
+    line_file: Path,
+    cache_dir: Path,
+    preallocate_loads: bool = False,
+) -> CompiledNetwork:
+    """
+    Returns the parsed configuration and the network built from it, loading them from a pickle in
+    cache_dir when one exists for the current contents of the three input files. Otherwise the network
+    is built as usual and cached for next time, replacing any cache built from older inputs
+    """
+    key = _network_inputs_hash((cable_file, node_file, line_file), preallocate_loads)[:16]
+    cache_dir = Path(cache_dir)
+    cache_path = cache_dir / f"network-{key}.pkl"
+
+    if cache_path.exists():
+        try:
+            with open(cache_path, "rb") as f:
+                compiled = pickle.load(f)
+            logging.info(f"Loaded compiled network from {cache_path}")
+            return compiled
+        except Exception as err:
+            logging.warning(f"Could not load compiled network {cache_path}, rebuilding it: {err}")
+
+    cable_types = load_cable_types(cable_file)
+    nodes = load_nodes_from_disk(node_file)
+    lines = load_lines_from_disk(line_file)
+    net, total_rating = build_network(nodes, lines, cable_types, preallocate_loads=preallocate_loads)
+    compiled = CompiledNetwork(cable_types, nodes, lines, net, total_rating)
+
+    try:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        temp_path = cache_path.with_suffix(".tmp")
+        with open(temp_path, "wb") as f:
+            pickle.dump(compiled, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, cache_path)
+
+        for stale in cache_dir.glob("network-*.pkl"):
+            if stale != cache_path:
+                stale.unlink()
+        logging.info(f"Compiled network cached at {cache_path}")
+    except OSError as err:
+        logging.warning(f"Could not cache compiled network: {err}")
+
+    return compiled
+
+
+# Settings a client can change on a running network with a config_update message
+NODE_CONFIG_FIELDS = {"rating": float, "load_scale_factor": float}
+LINE_CONFIG_FIELDS = {"is_active": bool, "type": str, "length": float}
+
+
+def _line_tile_id(line: Line) -> str:
+    # Must match the id Line.serialise gives the client
+    return str(line.id) if line.id != 0 else '100'
+
+
+def _set_line_active(net, nodes: Dict[int, ActiveNode], line: Line, active: bool):
+    line.is_active = active
+    if line.line_object is not None:
+        net.line.at[line.line_object, "in_service"] = active
+        return
+
+    # Lines inactive at build time were never given to pandapower, so create them now
+    if active:
+        by_name = {node.name: node for node in nodes.values()}
+        if line.line_from not in by_name or line.line_to not in by_name:
+            raise ValueError(f"No existing node for line {line.name}")
+        line.line_object = pp.create_line(
+            net,
+            from_bus=by_name[line.line_from].node_object,
+            to_bus=by_name[line.line_to].node_object,
+            length_km=line.length / 1000,
+            std_type=line.type,
+            name=line.name,
+        )
+
+
+def apply_config_update(net, nodes: Dict[int, ActiveNode], lines: Dict[int, Line], tile_id: str, config: dict) -> bool:
+    """
+    Applies a client config_update for one node or line as an in place edit of the nodes, lines and
+    pandapower network, keeping model histories and the previous solution. Lines accept is_active,
+    type (a registered cable name) and length (in metres); nodes accept rating and load_scale_factor.
+    Other keys are ignored.
+
+    Returns True if the network's lines changed, in which case solvers that cache the network
+    (RadialSweepSolver) need rebuilding. Raises ValueError for an unknown id or a bad value, including
+    a rating, load_scale_factor or length that is not a positive finite number
+    """
+    if not isinstance(config, dict):
+        raise ValueError(f"Config for id={tile_id} must be an object, got {type(config).__name__}")
+
+    node = nodes.get(int(tile_id)) if str(tile_id).isdigit() else None
+    line = next((line for line in lines.values() if _line_tile_id(line) == str(tile_id)), None)
+    if node is None and line is None:
+        raise ValueError(f"No node or line with id={tile_id}")
+
+    fields = NODE_CONFIG_FIELDS if node is not None else LINE_CONFIG_FIELDS
+    values = {}
+    for key, value in config.items():
+        if key not in fields:
+            logging.debug(f"Ignoring unsupported config field {key} for id={tile_id}")
+            continue
+        if fields[key] is bool:
+            values[key] = value if isinstance(value, bool) else string_to_bool(str(value))
+        else:
+            values[key] = fields[key](value)
+            # A NaN or non positive rating or scale factor turns into NaN loads or a division by zero
+            if fields[key] is float and not (math.isfinite(values[key]) and values[key] > 0):
+                raise ValueError(f"{key} must be a positive finite number, got {value!r}")
+
+    if node is not None:
+        for key, value in values.items():
+            setattr(node, key, value)
+        return False
+
+    if "type" in values:
+        if not pp.std_type_exists(net, values["type"], element="line"):
+            raise ValueError(f"Unknown cable type {values['type']}")
+        line.type = values["type"]
+        if line.line_object is not None:
+            pp.change_std_type(net, line.line_object, line.type, element="line")
+
+    if "length" in values:
+        line.length = values["length"]
+        if line.line_object is not None:
+            net.line.at[line.line_object, "length_km"] = line.length / 1000
+
+    if "is_active" in values:
+        _set_line_active(net, nodes, line, values["is_active"])
+
+    return bool(values)
@@ -0,0 +1,220 @@
+import importlib
+import logging
+import multiprocessing
+import sys
+import threading
+import time
+import traceback
+import types
+from contextlib import contextmanager
+from multiprocessing.connection import wait
+
+# Seconds a worker may stay busy with one request before it is assumed hung and restarted
+HUNG_WORKER_TIMEOUT = 5.0
+# Seconds a new worker has to import its plugin and report ready before it is restarted
+WORKER_STARTUP_TIMEOUT = 30.0
+
+# Sent by a worker once its plugin is imported and registered
+READY = "ready"
+
+_start_lock = threading.Lock()
+
+
+def _sync_observations(model, node_ids, histories, last_seen):
+    # Streaming models keep their state in this process, so catch them up on readings taken since the
+    # last request. Readings are identified by their timestamp
+    for node_id, history in zip(node_ids, histories):
+        newest = last_seen.get(node_id)
+        for time_, value in history:
+            if newest is None or time_ > newest:
+                model.observe(node_id, time_, value)
+        if len(history):
+            last_seen[node_id] = history[-1][0]
+
+
+def _worker_main(modname, connection, streaming):
+    from plugin_host import is_streaming_model, predict
+
+    module = importlib.import_module(modname)
+    model = module.Plugin(None)
+    model.register()
+    last_seen = {}
+    connection.send(READY)
+
+    while True:
+        try:
+            message = connection.recv()
+        except EOFError:
+            break
+        if message is None:
+            break
+
+        tick, node_ids, histories = message
+        try:
+            if streaming and is_streaming_model(model):
+                _sync_observations(model, node_ids, histories, last_seen)
+            connection.send((tick, predict(model, node_ids, histories, streaming), None))
+        except Exception:
+            connection.send((tick, None, traceback.format_exc()))
+
+
+@contextmanager
+def _without_main_module():
+    # A spawned process normally imports the parent's __main__ (main.py and everything it pulls in)
+    # before running its target. Workers only need their plugin, so hide __main__ while one starts
+    main_module = sys.modules["__main__"]
+    with _start_lock:
+        sys.modules["__main__"] = types.ModuleType("__main__")
+        try:
+            yield
+        finally:
+            sys.modules["__main__"] = main_module
+
+
+class _Worker:
+    def __init__(self, context, modname, streaming):
+        self.modname = modname
+        self.connection, child = context.Pipe()
+        self.process = context.Process(target=_worker_main, args=(modname, child, streaming), daemon=True)
+        with _without_main_module():
+            self.process.start()
+        child.close()
+        self.started_at = time.monotonic()
+        self.ready = False
+        self.pending = None  # Tick of the request the worker is still busy with
+        self.sent_at = None  # time.monotonic() when that request was sent
+
+    def stop(self):
+        # Only an idle worker can be asked to exit, a busy one may never read the request
+        if self.pending is None:
+            try:
+                self.connection.send(None)
+                self.process.join(timeout=0.5)
+            except (BrokenPipeError, OSError):
+                pass
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join(timeout=0.5)
+        self.connection.close()
+
+
+class ModelExecutor:
+    """
+    Runs MODEL plugins in worker processes, one per plugin module, so a slow, hung or crashing model
+    cannot hold up the simulation loop. Every tick all models are asked at once and given a shared
+    deadline; any model that has not answered by then, or that raised, comes back as None for the tick.
+
+    A new worker is not sent work until it reports that its plugin is loaded. A worker that is still
+    busy from an earlier tick is not sent new work either, and one that stays busy with a request for
+    HUNG_WORKER_TIMEOUT seconds is killed and started again. Workers import their plugin themselves, so
+    discard() must be called whenever a plugin is reloaded or unloaded
+    """
+
+    def __init__(self, deadline: float = 1.0, streaming: bool = True):
+        self.deadline = deadline
+        self.streaming = streaming  # Passed on to plugin_host.predict in the workers
+        self.workers = {}
+        self._context = multiprocessing.get_context("spawn")
+        self._tick = 0
+        # Modname -> round trip in nanoseconds for the models that answered the last tick
+        self.latencies = {}
+
+    def _worker(self, modname):
+        worker = self.workers.get(modname)
+        if worker is not None and not worker.process.is_alive():
+            logging.warning(f"[HotReloadingModule 🔥] Worker for {modname} exited, restarting it")
+            self.discard(modname)
+            worker = None
+
+        if worker is None:
+            worker = self.workers[modname] = _Worker(self._context, modname, self.streaming)
+        return worker
+
+    def _receive(self, worker):
+        try:
+            tick, predictions, error = worker.connection.recv()
+        except (EOFError, OSError):
+            return None, None
+
+        if error:
+            logging.warning(f"[HotReloadingModule 🔥] ⚠️ {worker.modname} failed to predict:\n{error}")
+        worker.pending = None
+        worker.sent_at = None
+        return tick, predictions
+
+    def _check_ready(self, worker) -> bool:
+        if worker.connection.poll():
+            try:
+                worker.ready = worker.connection.recv() == READY
+            except (EOFError, OSError):
+                return False
+            return worker.ready
+
+        if time.monotonic() - worker.started_at >= WORKER_STARTUP_TIMEOUT:
+            logging.warning(f"[HotReloadingModule 🔥] ⚠️ {worker.modname} did not start in time, restarting it")
+            self.discard(worker.modname)
+        return False
+
+    def predict_all(self, modnames, node_ids, histories_for):
+        """
+        Returns {modname: predictions or None}. histories_for(modname) gives the histories to send to
+        that model, in the same order as node_ids
+        """
+        self._tick += 1
+        self.latencies = {}
+        deadline = time.perf_counter() + self.deadline
+        sent_at = {}
+        results = {modname: None for modname in modnames}
+        waiting = {}
+
+        for modname in modnames:
+            worker = self._worker(modname)
+
+            # Still importing its plugin, which is not counted against the hang timeout
+            if not worker.ready and not self._check_ready(worker):
+                continue
+
+            if worker.pending is not None:
+                # Throw away a late answer to an earlier tick, if it has arrived
+                if worker.connection.poll():
+                    self._receive(worker)
+                else:
+                    if time.monotonic() - worker.sent_at >= HUNG_WORKER_TIMEOUT:
+                        logging.warning(f"[HotReloadingModule 🔥] ⚠️ {modname} looks hung, restarting it")
+                        self.discard(modname)
+                    continue
+
+            try:
+                worker.connection.send((self._tick, node_ids, histories_for(modname)))
+            except (BrokenPipeError, OSError):
+                self.discard(modname)
+                continue
+            worker.pending = self._tick
+            worker.sent_at = time.monotonic()
+            sent_at[modname] = time.perf_counter_ns()
+            waiting[worker.connection] = worker
+
+        while waiting:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            for connection in wait(list(waiting), timeout=remaining):
+                worker = waiting.pop(connection)
+                tick, predictions = self._receive(worker)
+                if tick == self._tick:
+                    results[worker.modname] = predictions
+                    self.latencies[worker.modname] = time.perf_counter_ns() - sent_at[worker.modname]
+
+        for worker in waiting.values():
+            logging.warning(f"[HotReloadingModule 🔥] ⚠️ {worker.modname} missed the {self.deadline}s deadline")
+
+        return results
+
+    def discard(self, modname):
+        worker = self.workers.pop(modname, None)
+        if worker is not None:
+            worker.stop()
+
+    def shutdown(self):
+        for modname in list(self.workers):
+            self.discard(modname)
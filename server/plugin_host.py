@@ -1,22 +1,42 @@
 import queue
-import threading
-import os, time, importlib, inspect, hashlib
+import os, time, importlib, inspect
 from types import ModuleType
 import traceback
 import logging
+import weakref
+
+import numpy as np
+
+import plugin_watcher
+from lib.latency import LatencyHistogram
+from plugin_executor import ModelExecutor
+
+# History assumed for MODEL plugins that do not declare a LOOKBACK. One week of readings plus one
+DEFAULT_LOOKBACK = 96 * 7 + 1
 
 
 class PluginHost:
-    def __init__(self, plugin_dir="plugins", poll_interval=2.0):
+    def __init__(
+        self, plugin_dir="plugins", poll_interval=2.0, isolate_models=False, model_deadline=1.0, streaming_models=True
+    ):
         self.plugin_dir = plugin_dir
         self.poll_interval = poll_interval
+        # With streaming_models set, models offering observe/forecast are fed one reading at a time and
+        # asked for their running forecast. Otherwise every model predicts from the node histories, in one
+        # predict_batch call where it has one
+        self.streaming_models = streaming_models
+        # With isolate_models set, MODEL plugins predict in worker processes under a per-tick deadline
+        self._executor = ModelExecutor(model_deadline, streaming_models) if isolate_models else None
         self.plugins = {}
         self.module_hashes = {}
         self._listeners = {}
+        # Plugin name -> hook name -> LatencyHistogram, reset whenever the plugin is (re)loaded
+        self.stats = {}
+        # Streaming model instance -> node ids it has been given the history of
+        self._observed_nodes = weakref.WeakKeyDictionary()
 
         self._queue = queue.Queue()
-        self._watcher_thread = None
-        self._stop_event = threading.Event()
+        self._watching = False
 
     def start(self):
         logging.info("[HotReloadingModule 🔥] Starting plugin host...")
@@ -30,40 +50,10 @@ class PluginHost:
             self.unload_all()
 
     def _calc_hash(self, path):
-        if not os.path.exists(path):
-            logging.warning(f"[HotReloadingModule 🔥] Tried to load plugin with invalid path={path}")
-            return None
-        sha = hashlib.sha256()
-
-        if os.path.isdir(path):
-            for root, _, files in os.walk(path):
-                for f in sorted(files):
-                    if f.endswith(".py"):
-                        full = os.path.join(root, f)
-                        with open(full, "rb") as fp:
-                            sha.update(fp.read())
-        else:
-            with open(path, "rb") as fp:
-                sha.update(fp.read())
-
-        return sha.hexdigest()
+        return plugin_watcher.hash_plugin(path)
 
     def discover(self):
-        entries = []
-        for entry in os.listdir(self.plugin_dir):
-            if entry.startswith("_"):
-                continue
-            full_path = os.path.join(self.plugin_dir, entry)
-            
-            logging.debug(f"[HotReloadingModule 🔥] Found plugin candidate {full_path}")
-
-            if entry.endswith(".py"):
-                entries.append(entry)
-
-            elif os.path.isdir(full_path) and os.path.isfile(os.path.join(full_path, "__init__.py")):
-                entries.append(entry)
-
-        return entries
+        return plugin_watcher.discover_plugins(self.plugin_dir)
 
     def load_all(self):
         for name in self.discover():
@@ -91,7 +81,8 @@ class PluginHost:
                 return
 
             instance = plugin_cls(self)
-            instance.register()
+            self.stats[name] = {}
+            self._timed(name, "register", instance.register)
 
             self.plugins[name] = (module, instance, hash_)
             logging.info(f"[HotReloadingModule 🔥] ✅ Registered plugin: {name}")
@@ -104,11 +95,14 @@ class PluginHost:
         if name not in self.plugins:
             return
         module, instance, _ = self.plugins.pop(name)
+        if self._executor:
+            self._executor.discard(module.__name__)
         try:
-            instance.deregister()
+            self._timed(name, "deregister", instance.deregister)
             logging.info(f"[HotReloadingModule 🔥] 🧹 Unloaded plugin: {name}")
         except Exception:
             logging.warning(f"[HotReloadingModule 🔥] ⚠️ Error during unload of {name}")
+        self.stats.pop(name, None)
 
     def reload_plugin(self, name):
         if name not in self.plugins:
@@ -122,8 +116,10 @@ class PluginHost:
             return
         
         logging.info(f"[HotReloadingModule 🔥] 🔄 Reloading plugin: {name}")
+        if self._executor:
+            self._executor.discard(module.__name__)
         try:
-            instance.deregister()
+            self._timed(name, "deregister", instance.deregister)
         except Exception:
             logging.error(f"[HotReloadingModule 🔥] ⚠️  Error during deregistration of {name}")
             traceback.print_exc()
@@ -136,8 +132,10 @@ class PluginHost:
                 del self.plugins[name]
                 return
 
+            # Fresh stats so the new version can be compared against the old one
             instance = plugin_cls(self)
-            instance.register()
+            self.stats[name] = {}
+            self._timed(name, "register", instance.register)
 
             self.plugins[name] = (module, instance, new_hash)
             logging.info(f"[HotReloadingModule 🔥] ✅ Reloaded plugin: {name}")
@@ -146,6 +144,28 @@ class PluginHost:
             logging.info(f"[HotReloadingModule 🔥] ❌ Failed to reload plugin '{name}'")
             traceback.print_exc()
 
+    def _plugin_name(self, instance):
+        for name, (_, plugin, _) in self.plugins.items():
+            if plugin is instance:
+                return name
+        return None
+
+    def _record(self, name, hook, duration_ns, failed=False):
+        if name not in self.stats:
+            return
+        self.stats[name].setdefault(hook, LatencyHistogram()).record(duration_ns, failed)
+
+    def _timed(self, name, hook, fn, *args, **kwargs):
+        """Calls fn, recording how long it took and whether it raised against the plugin's hook"""
+        start = time.perf_counter_ns()
+        failed = True
+        try:
+            result = fn(*args, **kwargs)
+            failed = False
+            return result
+        finally:
+            self._record(name, hook, time.perf_counter_ns() - start, failed)
+
     def _instantiate(self, module: ModuleType):
         for _, cls in inspect.getmembers(module, inspect.isclass):
             if hasattr(cls, "register") and hasattr(cls, "deregister") and hasattr(cls, "get_type"):
@@ -181,57 +201,29 @@ class PluginHost:
     def emit_event(self, event, *args, **kwargs):
         for cb in self._listeners.get(event, []):
             try:
-                cb(*args, **kwargs)
+                self._timed(self._plugin_name(getattr(cb, "__self__", None)), event, cb, *args, **kwargs)
             except Exception as e:
                 logging.info(f"[HotReloadingModule 🔥] Error in handler '{event}': {e}")
 
-    def _watch_for_changes(self):
-        last_seen = {}
-
-        while not self._stop_event.is_set():
-            for name in self.discover():
-                path = os.path.join(self.plugin_dir, name)
-                hash_ = self._calc_hash(path)
-
-                if not hash_:
-                    logging.debug(f"[HotReloadingModule 🔥] Failed to hash plugin {path}")
-                    continue
-
-                logging.debug(f"[HotReloadingModule 🔥] Successfully generated hash for plugin {path}={hash_}")
-
-                old_hash = last_seen.get(name)
-                last_seen[name] = hash_
-
-                if old_hash is None and name not in self.plugins:
-                    self._queue.put(("load", name))
-                elif old_hash != hash_:
-                    self._queue.put(("reload", name))
-
-            for name in list(last_seen.keys()):
-                path = os.path.join(self.plugin_dir, name)
-                if not os.path.exists(path):
-                    last_seen.pop(name)
-                    self._queue.put(("unload", name))
-
-
-            logging.debug("[HotReloadingModule 🔥] Fired watch event loop")
-            time.sleep(self.poll_interval)
-        
     def start_watcher(self):
-        if self._watcher_thread and self._watcher_thread.is_alive():
+        """Subscribes to the shared watcher for this plugin directory"""
+        if self._watching:
             return
-        self._stop_event.clear()
-        self._watcher_thread = threading.Thread(target=self._watch_for_changes, daemon=True)
-        self._watcher_thread.start()
+        plugin_watcher.subscribe(self.plugin_dir, self._queue, self.poll_interval)
+        self._watching = True
         logging.info("[HotReloadingModule 🔥] 🔍 Plugin watcher started.")
 
     def stop_watcher(self):
-        if not self._watcher_thread:
+        if not self._watching:
             return
-        self._stop_event.set()
-        self._watcher_thread.join(timeout=3)
+        plugin_watcher.unsubscribe(self.plugin_dir, self._queue)
+        self._watching = False
         logging.info("[HotReloadingModule 🔥] 🛑 Plugin watcher stopped.")
 
+    def stop_model_workers(self):
+        if self._executor:
+            self._executor.shutdown()
+
     def process_plugin_events(self):
         try:
             while True:
@@ -250,13 +242,28 @@ class PluginHost:
 
     def __type_schema_check(self, type, classobj):
         if type == "MODEL":
-            if hasattr(classobj, "predict_next") and hasattr(classobj, "get_formatted_name"):
-                return True
-            else: return False
+            if not hasattr(classobj, "get_formatted_name"):
+                return False
+            return hasattr(classobj, "predict_next") or is_streaming_model(classobj)
 
         return True
 
-    def get_all_plugins(self, type: str = None):
+    def get_all_plugins(self, type: str = None, metadata: bool = False):
+        """
+        With a type, the loaded plugins of that type that pass its schema check. Otherwise every loaded
+        plugin as name -> (module, instance, hash). With metadata set, returns name -> {"type", "stats"}
+        instead, where stats holds a LatencyHistogram summary per hook the plugin has been called on
+        """
+        if metadata:
+            return {
+                name: {
+                    "type": instance.get_type(),
+                    "stats": {hook: histogram.summary() for hook, histogram in self.stats.get(name, {}).items()},
+                }
+                for name, (_, instance, _) in self.plugins.items()
+                if type is None or instance.get_type() == type
+            }
+
         if type:
 
             typed_plugins = []
@@ -271,6 +278,120 @@ class PluginHost:
         else:
             return self.plugins
 
+    def get_history_capacity(self):
+        """
+        The number of readings each node needs to keep so every loaded model can see the history it asks
+        for. MODEL plugins declare this with a LOOKBACK class attribute
+        """
+        lookbacks = [
+            getattr(model, "LOOKBACK", DEFAULT_LOOKBACK) for model in self.get_all_plugins("MODEL")
+        ]
+        return max(lookbacks, default=1)
+
+    def predict_all(self, models, node_ids, histories):
+        """
+        Runs every model over the given nodes and returns one entry per model, in order: a list with a
+        prediction (or None) per node, or None if the model failed or, when models are isolated in
+        worker processes, missed this tick's deadline
+        """
+        if not self._executor:
+            return [self.predict_batch(model, node_ids, histories) for model in models]
+
+        modnames = [type(model).__module__ for model in models]
+        lookbacks = {
+            modname: getattr(model, "LOOKBACK", DEFAULT_LOOKBACK) for modname, model in zip(modnames, models)
+        }
+
+        # Workers only need as much history as each model looks back over
+        truncated = {}
+
+        def histories_for(modname):
+            lookback = lookbacks[modname]
+            if lookback not in truncated:
+                truncated[lookback] = [history.resize(min(lookback, history.capacity)) for history in histories]
+            return truncated[lookback]
+
+        results = self._executor.predict_all(modnames, node_ids, histories_for)
+
+        deadline_ns = int(self._executor.deadline * 1e9)
+        for modname, model in zip(modnames, models):
+            latency = self._executor.latencies.get(modname)
+            failed = results[modname] is None
+            self._record(self._plugin_name(model), "predict", deadline_ns if latency is None else latency, failed)
+
+        return [results[modname] for modname in modnames]
+
+    def predict_batch(self, model, node_ids, histories):
+        """
+        One prediction per node, in order, with None where the model has nothing to offer yet, or None
+        in place of the list if the model raised.
+
+        Streaming models (see observe) are asked for their forecast of each node while streaming_models
+        is set. Otherwise MODEL plugins that implement predict_batch(matrix) are called once with a
+        (nodes x LOOKBACK) matrix holding the last LOOKBACK readings of every node that has that many.
+        Nodes with less history get None without being passed in. Anything else falls back to
+        predict_next per node
+        """
+        try:
+            return self._timed(
+                self._plugin_name(model), "predict", predict, model, node_ids, histories, self.streaming_models
+            )
+        except Exception:
+            logging.warning(f"[HotReloadingModule 🔥] ⚠️ {model.get_formatted_name()} failed to predict")
+            traceback.print_exc()
+            return None
+
+    def observe(self, models, node_id, history):
+        """
+        Passes the newest reading in a node's history to every streaming model. MODEL plugins opt in
+        by implementing observe(node_id, time, value) and forecast(node_id) instead of predict_next,
+        and keep whatever running state they need between calls. A model that has not seen this node
+        before, such as one that was just loaded or reloaded, is given the whole history first
+        """
+        # Isolated models are caught up by their worker from the histories sent with each request
+        if not len(history) or self._executor or not self.streaming_models:
+            return
+
+        for model in models:
+            if not is_streaming_model(model):
+                continue
+
+            seen = self._observed_nodes.setdefault(model, set())
+            name = self._plugin_name(model)
+            readings = [history[-1]] if node_id in seen else history
+            # A node is only replayed once either way, so a model that raised part way through is not fed
+            # the same readings twice
+            seen.add(node_id)
+            try:
+                for reading_time, value in readings:
+                    self._timed(name, "observe", model.observe, node_id, reading_time, value)
+            except Exception:
+                logging.warning(f"[HotReloadingModule 🔥] ⚠️ {model.get_formatted_name()} failed to observe node {node_id}")
+                traceback.print_exc()
+
+
+def predict(model, node_ids, histories, streaming=True):
+    if streaming and is_streaming_model(model):
+        return [model.forecast(node_id) for node_id in node_ids]
+
+    batch = getattr(model, "predict_batch", None)
+    lookback = getattr(model, "LOOKBACK", None)
+    if batch is None or lookback is None:
+        return [model.predict_next(history) for history in histories]
+
+    predictions = [None] * len(histories)
+    ready = [i for i, history in enumerate(histories) if len(history) >= lookback]
+    if ready:
+        matrix = np.stack([histories[i].window(lookback) for i in ready])
+        for i, value in zip(ready, batch(matrix)):
+            predictions[i] = float(value)
+    return predictions
+
+
+def is_streaming_model(model):
+    return hasattr(model, "observe") and hasattr(model, "forecast")
+
+
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
     host = PluginHost("./plugins")
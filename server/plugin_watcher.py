@@ -0,0 +1,299 @@
+import ctypes
+import ctypes.util
+import hashlib
+import logging
+import os
+import select
+import struct
+import sys
+import threading
+
+# inotify(7) event masks
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = (
+    IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+)
+EVENT_HEADER = struct.Struct("iIII")
+
+SETTLE_TIME = 0.1  # Seconds to keep collecting events after the first one, so a burst of writes is handled once
+
+
+def discover_plugins(plugin_dir):
+    """Names of the plugin modules and packages in plugin_dir, skipping anything starting with _"""
+    entries = []
+    for entry in os.listdir(plugin_dir):
+        if entry.startswith("_"):
+            continue
+        full_path = os.path.join(plugin_dir, entry)
+
+        logging.debug(f"[HotReloadingModule 🔥] Found plugin candidate {full_path}")
+
+        if entry.endswith(".py"):
+            entries.append(entry)
+
+        elif os.path.isdir(full_path) and os.path.isfile(os.path.join(full_path, "__init__.py")):
+            entries.append(entry)
+
+    return entries
+
+
+def _plugin_files(path):
+    if os.path.isdir(path):
+        for root, _, files in os.walk(path):
+            for f in sorted(files):
+                if f.endswith(".py"):
+                    yield os.path.join(root, f)
+    else:
+        yield path
+
+
+def hash_plugin(path):
+    if not os.path.exists(path):
+        logging.warning(f"[HotReloadingModule 🔥] Tried to load plugin with invalid path={path}")
+        return None
+    sha = hashlib.sha256()
+
+    for full in _plugin_files(path):
+        with open(full, "rb") as fp:
+            sha.update(fp.read())
+
+    return sha.hexdigest()
+
+
+def stat_plugin(path):
+    """
+    Cheap fingerprint of a plugin from the mtime and size of its files. Only a change in this is worth
+    hashing the plugin for. Returns None if the plugin no longer exists
+    """
+    try:
+        return tuple(
+            (full, st.st_mtime_ns, st.st_size) for full, st in ((f, os.stat(f)) for f in _plugin_files(path))
+        )
+    except FileNotFoundError:
+        return None
+
+
+class _Inotify:
+    """Minimal ctypes binding for inotify, watching a directory tree"""
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.paths = {}
+
+    def watch_tree(self, root):
+        for directory, subdirs, _ in os.walk(root):
+            subdirs[:] = [d for d in subdirs if d != "__pycache__"]
+            wd = self._add_watch(self.fd, os.fsencode(directory), WATCH_MASK)
+            if wd < 0:
+                raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {directory}")
+            self.paths[wd] = directory
+
+    def read(self, timeout):
+        """Blocks for up to timeout seconds and returns (directory, mask, name) for each event"""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+
+        try:
+            buffer = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+
+        events = []
+        offset = 0
+        while offset < len(buffer):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(buffer, offset)
+            offset += EVENT_HEADER.size
+            name = buffer[offset : offset + length].rstrip(b"\0").decode(errors="replace")
+            offset += length
+            events.append((self.paths.get(wd), mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PluginWatcher:
+    """
+    Watches one plugin directory for the life of its subscribers and pushes ("load" | "reload" |
+    "unload", name) events onto every subscribed queue. On Linux the thread sleeps on inotify and only
+    looks at the plugins named in the events; elsewhere, or if inotify is unavailable, it polls. Either
+    way a plugin is only hashed when the mtime or size of one of its files has changed, and only
+    reported when the hash has.
+
+    Use subscribe() and unsubscribe() rather than creating these directly so hosts watching the same
+    directory share one watcher
+    """
+
+    def __init__(self, plugin_dir, poll_interval=2.0):
+        self.plugin_dir = plugin_dir
+        self.poll_interval = poll_interval
+        self.subscribers = []
+
+        self._stats = {}
+        self._hashes = {}
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._inotify = None
+
+    def _publish(self, action, name):
+        with self._lock:
+            subscribers = list(self.subscribers)
+        for subscriber in subscribers:
+            subscriber.put((action, name))
+
+    def _check(self, name, present):
+        path = os.path.join(self.plugin_dir, name)
+        stat = stat_plugin(path) if present else None
+
+        if stat is None:
+            if self._hashes.pop(name, None) is not None:
+                self._stats.pop(name, None)
+                self._publish("unload", name)
+            return
+
+        if stat == self._stats.get(name):
+            return
+        self._stats[name] = stat
+
+        hash_ = hash_plugin(path)
+        if not hash_:
+            logging.debug(f"[HotReloadingModule 🔥] Failed to hash plugin {path}")
+            return
+
+        old_hash = self._hashes.get(name)
+        self._hashes[name] = hash_
+        if old_hash is None:
+            self._publish("load", name)
+        elif old_hash != hash_:
+            self._publish("reload", name)
+
+    def scan(self, names=None):
+        """Checks the named plugins, or everything in the directory and everything seen before"""
+        discovered = set(discover_plugins(self.plugin_dir))
+        if names is None:
+            names = discovered | set(self._hashes)
+        for name in sorted(names):
+            self._check(name, name in discovered)
+
+    def _watch_inotify(self):
+        while not self._stop_event.is_set():
+            events = self._inotify.read(self.poll_interval)
+            if not events:
+                continue
+            # Let a burst of writes from an editor or a copy land before looking at anything
+            while True:
+                more = self._inotify.read(SETTLE_TIME)
+                if not more:
+                    break
+                events.extend(more)
+
+            names = set()
+            for directory, mask, name in events:
+                if mask & IN_Q_OVERFLOW or directory is None:
+                    names = None
+                    break
+
+                relative = os.path.relpath(os.path.join(directory, name), self.plugin_dir)
+                names.add(relative.split(os.sep)[0])
+
+                if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                    try:
+                        self._inotify.watch_tree(os.path.join(directory, name))
+                    except OSError as err:
+                        logging.warning(f"[HotReloadingModule 🔥] Could not watch new directory {name}: {err}")
+
+            self.scan(names)
+            logging.debug("[HotReloadingModule 🔥] Handled plugin directory events")
+
+    def _watch_polling(self):
+        while not self._stop_event.wait(self.poll_interval):
+            self.scan()
+            logging.debug("[HotReloadingModule 🔥] Fired watch event loop")
+
+    def start(self):
+        if sys.platform.startswith("linux"):
+            try:
+                self._inotify = _Inotify()
+                self._inotify.watch_tree(self.plugin_dir)
+            except (OSError, AttributeError) as err:
+                logging.warning(f"[HotReloadingModule 🔥] inotify unavailable, polling for plugin changes: {err}")
+                self._inotify = None
+
+        self.scan()
+        self._stop_event.clear()
+        target = self._watch_inotify if self._inotify else self._watch_polling
+        self._thread = threading.Thread(target=target, daemon=True)
+        self._thread.start()
+        logging.info(
+            f"[HotReloadingModule 🔥] 🔍 Watching {self.plugin_dir} with {'inotify' if self._inotify else 'polling'}."
+        )
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join(timeout=3)
+        if self._inotify:
+            self._inotify.close()
+            self._inotify = None
+
+
+_watchers = {}
+_watchers_lock = threading.Lock()
+
+
+def subscribe(plugin_dir, events, poll_interval=2.0) -> PluginWatcher:
+    """
+    Registers a queue for plugin events from plugin_dir, starting the directory's watcher if this is the
+    first subscriber. The queue is sent a load event for every plugin already present
+    """
+    key = os.path.realpath(plugin_dir)
+    with _watchers_lock:
+        watcher = _watchers.get(key)
+        if watcher is None:
+            watcher = _watchers[key] = PluginWatcher(plugin_dir, poll_interval)
+            watcher.subscribers.append(events)
+            watcher.start()
+            return watcher
+
+        with watcher._lock:
+            watcher.subscribers.append(events)
+        for name in list(watcher._hashes):
+            events.put(("load", name))
+        return watcher
+
+
+def unsubscribe(plugin_dir, events):
+    """Removes a queue, stopping the directory's watcher once nothing is subscribed"""
+    key = os.path.realpath(plugin_dir)
+    with _watchers_lock:
+        watcher = _watchers.get(key)
+        if watcher is None:
+            return
+
+        with watcher._lock:
+            if events in watcher.subscribers:
+                watcher.subscribers.remove(events)
+            remaining = len(watcher.subscribers)
+
+        if not remaining:
+            del _watchers[key]
+            watcher.stop()
+            logging.info(f"[HotReloadingModule 🔥] 🛑 Stopped watching {plugin_dir}.")
@@ -1,7 +1,12 @@
+from lib.rolling import LaggedValue
+
 class Plugin:
 
+    LOOKBACK = 1
+
     def __init__(self, host):
         self.host = host
+        self.last_values = {}
 
     def register(self):
         print("LastKnownValue model was loaded")
@@ -17,6 +22,18 @@ class Plugin:
     
         return None
 
+    def predict_batch(self, matrix):
+        return matrix[:, -1]
+
+    def observe(self, node_id, time, value):
+        if node_id not in self.last_values:
+            self.last_values[node_id] = LaggedValue(1)
+        self.last_values[node_id].update(value)
+
+    def forecast(self, node_id):
+        stats = self.last_values.get(node_id)
+        return stats.forecast() if stats else None
+
     def get_type(self):
         return "MODEL"
     
@@ -1,9 +1,13 @@
+from lib.rolling import LaggedValue
+
 class Plugin:
 
     NAME = "LastDayReplay"
+    LOOKBACK = 96
 
     def __init__(self, host):
         self.host = host
+        self.days = {}
 
     def register(self):
         print(f"{self.NAME} model was loaded")
@@ -17,6 +21,18 @@ class Plugin:
     
         return None
 
+    def predict_batch(self, matrix):
+        return matrix[:, -96]
+
+    def observe(self, node_id, time, value):
+        if node_id not in self.days:
+            self.days[node_id] = LaggedValue(96)
+        self.days[node_id].update(value)
+
+    def forecast(self, node_id):
+        stats = self.days.get(node_id)
+        return stats.forecast() if stats else None
+
     def get_type(self):
         return "MODEL"
     
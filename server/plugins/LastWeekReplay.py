@@ -1,9 +1,13 @@
+from lib.rolling import LaggedValue
+
 class Plugin:
 
     NAME = "LastWeekReplay"
+    LOOKBACK = 96 * 7 + 1  # Waits for more than a full week before predicting
 
     def __init__(self, host):
         self.host = host
+        self.weeks = {}
 
     def register(self):
         print(f"{self.NAME} model was loaded")
@@ -17,6 +21,21 @@ class Plugin:
     
         return None
 
+    def predict_batch(self, matrix):
+        return matrix[:, -96*7]
+
+    def observe(self, node_id, time, value):
+        if node_id not in self.weeks:
+            self.weeks[node_id] = LaggedValue(96*7)
+        self.weeks[node_id].update(value)
+
+    def forecast(self, node_id):
+        week = self.weeks.get(node_id)
+        # Matches predict_next, which waits for more than a full week
+        if week is None or week.count <= 96*7:
+            return None
+        return week.forecast()
+
     def get_type(self):
         return "MODEL"
     
@@ -1,8 +1,13 @@
 import numpy as np
 
+from lib.rolling import RollingPolyfit
+
 class Plugin:
+    LOOKBACK = 12
+
     def __init__(self, host):
         self.host = host
+        self.fits = {}
 
     def register(self):
         print("Linear 12-Period model was loaded")
@@ -14,7 +19,7 @@ class Plugin:
         if len(history) < 12:
             return None
 
-        values = np.array([v for _, v in history[-12:]], dtype=float)
+        values = history.window(12)
         x = np.arange(len(values))
 
         coeffs = np.polyfit(x, values, 1)
@@ -22,6 +27,22 @@ class Plugin:
 
         return float(poly(len(values)))
 
+    def predict_batch(self, matrix):
+        # The least squares fit over a fixed x is linear in the readings, so one set of weights
+        # extrapolates every node's fit at once
+        x = np.arange(matrix.shape[1])
+        weights = np.vander([len(x)], 2) @ np.linalg.pinv(np.vander(x, 2))
+        return matrix @ weights[0]
+
+    def observe(self, node_id, time, value):
+        if node_id not in self.fits:
+            self.fits[node_id] = RollingPolyfit(12, 1)
+        self.fits[node_id].update(value)
+
+    def forecast(self, node_id):
+        stats = self.fits.get(node_id)
+        return stats.forecast() if stats else None
+
     def get_type(self):
         return "MODEL"
 
@@ -1,9 +1,14 @@
 import numpy as np
 
+from lib.rolling import RollingPolyfit
+
 class Plugin:
+    LOOKBACK = 12
+
     def __init__(self, host, period: int = 12):
         self.host = host
         self.period = period
+        self.averages = {}
 
     def register(self):
         print(f"MovingAverage({self.period}) model was loaded")
@@ -15,9 +20,21 @@ class Plugin:
         if len(history) < self.period:
             return None
 
-        values = np.array([v for _, v in history[-self.period:]], dtype=float)
+        values = history.window(self.period)
         return float(np.mean(values))
 
+    def predict_batch(self, matrix):
+        return matrix[:, -self.period:].mean(axis=1)
+
+    def observe(self, node_id, time, value):
+        if node_id not in self.averages:
+            self.averages[node_id] = RollingPolyfit(self.period, 0)
+        self.averages[node_id].update(value)
+
+    def forecast(self, node_id):
+        stats = self.averages.get(node_id)
+        return stats.forecast() if stats else None
+
     def get_type(self):
         return "MODEL"
 
@@ -3,6 +3,7 @@ import random
 class Plugin:
 
     NAME = "RandomGarbage"
+    LOOKBACK = 1
 
     def __init__(self, host):
         self.host = host
@@ -0,0 +1,177 @@
+import json
+import math
+import struct
+
+import numpy as np
+
+# Websocket subprotocols a client can ask for. Clients that ask for nothing get JSON
+JSON_SUBPROTOCOL = "currently.json"
+BINARY_SUBPROTOCOL = "currently.binary"
+
+# Sections of the packet holding per tile entries keyed by "id"
+TILE_SECTIONS = ("line_data", "node_data")
+
+
+def _changed(old, new, epsilon: float) -> bool:
+    if isinstance(new, bool) or isinstance(old, bool):
+        return old != new
+    if isinstance(new, (int, float)) and isinstance(old, (int, float)):
+        if math.isnan(new) or math.isnan(old):
+            return not (math.isnan(new) and math.isnan(old))
+        return abs(new - old) > epsilon
+    if isinstance(new, dict) and isinstance(old, dict):
+        if new.keys() != old.keys():
+            return True
+        return any(_changed(old[key], new[key], epsilon) for key in new)
+    return old != new
+
+
+class DeltaEncoder:
+    """
+    Turns full packets into delta packets for the dashboard stream. A keyframe carrying every field is
+    emitted first and then every keyframe_interval ticks. In between, each tile entry only carries its
+    id plus the fields that moved more than epsilon away from the value the client last received.
+    site_totals is small and always sent whole. The client merges entries per tile id, so applying a
+    delta on top of the last keyframe reproduces the current state to within epsilon.
+    """
+
+    def __init__(self, epsilon: float = 1e-3, keyframe_interval: int = 96):
+        self.epsilon = epsilon
+        self.keyframe_interval = keyframe_interval
+        self._sent = None
+        self._ticks_since_keyframe = 0
+
+    def keyframe(self, data: dict) -> dict:
+        return {"type": "keyframe", **data}
+
+    def encode(self, data: dict) -> dict:
+        if self._sent is None or self._ticks_since_keyframe >= self.keyframe_interval:
+            self._sent = {
+                section: {entry["id"]: dict(entry) for entry in data[section]}
+                for section in TILE_SECTIONS
+            }
+            self._ticks_since_keyframe = 0
+            return self.keyframe(data)
+
+        self._ticks_since_keyframe += 1
+        packet = {"type": "delta"}
+
+        for section in TILE_SECTIONS:
+            sent = self._sent[section]
+            changes = []
+            for entry in data[section]:
+                previous = sent.setdefault(entry["id"], {})
+                delta = {
+                    key: value
+                    for key, value in entry.items()
+                    if key not in previous or _changed(previous[key], value, self.epsilon)
+                }
+                if delta:
+                    previous.update(delta)
+                    delta["id"] = entry["id"]
+                    changes.append(delta)
+            packet[section] = changes
+
+        for key, value in data.items():
+            if key not in TILE_SECTIONS:
+                packet[key] = value
+
+        return packet
+
+
+NODE_BINARY_FIELDS = ["voltage", "p_kw", "q_kvar", "phase", "online", "av", "bv", "cv", "ai", "bi", "ci"]
+LINE_BINARY_FIELDS = ["loading", "i"]
+
+# magic, schema version, node count, node field count, line count, line field count, trailer length
+BINARY_HEADER = struct.Struct("<4sIHHHHI")
+BINARY_MAGIC = b"CUR1"
+
+
+class BinaryEncoder:
+    """
+    Packs each tick into a fixed layout frame described by a schema message that the client receives
+    once, as a JSON text frame, before any binary frames. A frame is:
+
+        header        BINARY_HEADER
+        node block    float32[node count][node field count], rows in schema node_ids order
+        line block    float32[line count][line field count], rows in schema line_ids order
+        trailer       UTF-8 JSON with site_totals, model_perf (keyed by node id) and any other
+                      non tile sections of the packet
+
+    All values are little endian and missing values are NaN. Fields that never change, such as names
+    and ratings, live in the schema instead of the frames. The schema version is bumped, and a new
+    schema sent, whenever the set of tiles or their static fields change.
+    """
+
+    def __init__(self):
+        self._layout = None
+        self._version = 0
+
+    def _static(self, entries, fields):
+        return {
+            entry["id"]: {
+                key: value
+                for key, value in entry.items()
+                if key not in fields and key not in ("id", "model_perf")
+            }
+            for entry in entries
+        }
+
+    def _build_schema(self, data: dict) -> dict:
+        return {
+            "type": "schema",
+            "header": BINARY_HEADER.format,
+            "node_ids": [entry["id"] for entry in data["node_data"]],
+            "node_fields": NODE_BINARY_FIELDS,
+            "node_static": self._static(data["node_data"], NODE_BINARY_FIELDS),
+            "line_ids": [entry["id"] for entry in data["line_data"]],
+            "line_fields": LINE_BINARY_FIELDS,
+            "line_static": self._static(data["line_data"], LINE_BINARY_FIELDS),
+        }
+
+    def update_schema(self, data: dict) -> bool:
+        """Returns True if the schema changed and has to be resent to clients"""
+        layout = self._build_schema(data)
+        if layout == self._layout:
+            return False
+        self._layout = layout
+        self._version += 1
+        return True
+
+    def schema_packet(self) -> str:
+        return json.dumps({**self._layout, "version": self._version}, default=str)
+
+    def _block(self, entries, fields) -> bytes:
+        rows = [
+            [float(value) if value is not None else math.nan for value in (entry.get(field) for field in fields)]
+            for entry in entries
+        ]
+        return np.array(rows, dtype="<f4").reshape(len(entries), len(fields)).tobytes()
+
+    def encode(self, data: dict) -> bytes:
+        trailer = json.dumps(
+            {
+                **{key: value for key, value in data.items() if key not in TILE_SECTIONS},
+                "model_perf": {entry["id"]: entry.get("model_perf", {}) for entry in data["node_data"]},
+            },
+            default=str,
+        ).encode("utf-8")
+
+        header = BINARY_HEADER.pack(
+            BINARY_MAGIC,
+            self._version,
+            len(data["node_data"]),
+            len(NODE_BINARY_FIELDS),
+            len(data["line_data"]),
+            len(LINE_BINARY_FIELDS),
+            len(trailer),
+        )
+
+        return b"".join(
+            [
+                header,
+                self._block(data["node_data"], NODE_BINARY_FIELDS),
+                self._block(data["line_data"], LINE_BINARY_FIELDS),
+                trailer,
+            ]
+        )
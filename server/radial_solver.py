@@ -0,0 +1,229 @@
+import math
+from collections import deque
+
+import numpy as np
+import pandas as pd
+import pandapower as pp
+
+SQRT3 = math.sqrt(3)
+
+
+class RadialSweepSolver:
+    """
+    Backward/forward sweep load flow for radial networks built by network.build_network. The tree is
+    walked once up front and flattened into parent/branch index arrays grouped by depth, so each solve
+    is a handful of vectorised passes over the levels of the tree.
+
+    Reads net.bus, net.line, net.load and net.ext_grid and writes net.res_bus, net.res_line and
+    net.res_ext_grid with the same columns pandapower produces. Lines use the same pi model as
+    pandapower (series impedance plus half the line charging at each end) and loads are constant power.
+    Call rebuild() after any change to the network topology or line parameters.
+    """
+
+    def __init__(self, net, tolerance_kv: float = 1e-9, max_iterations: int = 50):
+        self.net = net
+        self.tolerance_kv = tolerance_kv
+        self.max_iterations = max_iterations
+        self._v = None
+        self.rebuild()
+
+    def rebuild(self, keep_solution: bool = False):
+        """
+        Re-reads the network. With keep_solution set, the last solution is kept for warm starts, which
+        is valid as long as no buses were added or removed
+        """
+        net = self.net
+        previous = self._v if keep_solution else None
+
+        if len(net.ext_grid) != 1:
+            raise ValueError("The radial solver requires exactly one external grid (slack bus)")
+
+        self._bus_lookup = pd.Index(net.bus.index)
+        n_bus = len(self._bus_lookup)
+        slack = self._bus_lookup.get_loc(net.ext_grid.bus.iloc[0])
+
+        lines = net.line[net.line.in_service]
+        from_pos = self._bus_lookup.get_indexer(lines.from_bus.to_numpy())
+        to_pos = self._bus_lookup.get_indexer(lines.to_bus.to_numpy())
+
+        adjacency = [[] for _ in range(n_bus)]
+        for i, (f, t) in enumerate(zip(from_pos, to_pos)):
+            adjacency[f].append((t, i))
+            adjacency[t].append((f, i))
+
+        parent = np.full(n_bus, -1, dtype=np.intp)
+        parent_line = np.full(n_bus, -1, dtype=np.intp)
+        depth = np.full(n_bus, -1, dtype=np.intp)
+        depth[slack] = 0
+
+        # Breadth first walk from the slack bus, any bus reached twice means a mesh
+        pending = deque([slack])
+        while pending:
+            bus = pending.popleft()
+            for neighbour, line in adjacency[bus]:
+                if line == parent_line[bus]:
+                    continue
+                if depth[neighbour] >= 0:
+                    raise ValueError("The network contains a loop and cannot be solved as radial")
+                depth[neighbour] = depth[bus] + 1
+                parent[neighbour] = bus
+                parent_line[neighbour] = line
+                pending.append(neighbour)
+
+        if (depth < 0).any():
+            isolated = list(self._bus_lookup[depth < 0])
+            raise ValueError(f"Buses {isolated} are not connected to the slack bus")
+
+        length = lines.length_km.to_numpy()
+        n_parallel = lines.parallel.to_numpy()
+        z_line = (lines.r_ohm_per_km.to_numpy() + 1j * lines.x_ohm_per_km.to_numpy()) * length / n_parallel
+        y_half = (
+            (lines.g_us_per_km.to_numpy() * 1e-6 + 2j * math.pi * net.f_hz * lines.c_nf_per_km.to_numpy() * 1e-9)
+            * length
+            * n_parallel
+            / 2
+        )
+
+        # Charging of every line is lumped half and half onto its end buses
+        y_bus = np.zeros(n_bus, dtype=complex)
+        np.add.at(y_bus, from_pos, y_half)
+        np.add.at(y_bus, to_pos, y_half)
+
+        children = parent_line >= 0
+        z_branch = np.zeros(n_bus, dtype=complex)
+        z_branch[children] = z_line[parent_line[children]]
+
+        # For each line, the bus at the far end from the slack bus
+        line_child = np.empty(len(lines), dtype=np.intp)
+        line_child[parent_line[children]] = np.flatnonzero(children)
+
+        self._slack = slack
+        self._parent = parent
+        self._levels = [np.flatnonzero(depth == d) for d in range(1, depth.max() + 1)]
+        self._z_branch = z_branch
+        self._y_bus = y_bus
+        self._y_half = y_half
+        self._line_index = lines.index
+        self._line_child = line_child
+        self._line_parent = parent[line_child]
+        self._from_is_parent = from_pos == self._line_parent
+        self._rated_i_ka = lines.max_i_ka.to_numpy() * lines.df.to_numpy() * n_parallel
+        self._vn_ph = net.bus.vn_kv.to_numpy() / SQRT3
+        self._v = previous if previous is not None and len(previous) == n_bus else None
+
+    def _injections(self, s_bus, v):
+        # Per phase load current plus line charging, then summed up the tree so each non-slack
+        # entry holds the series current of the branch feeding it
+        i = np.conj(s_bus / 3 / v) + self._y_bus * v
+        for level in reversed(self._levels):
+            np.add.at(i, self._parent[level], i[level])
+        return i
+
+    def solve(self, warm_start: bool = False) -> int:
+        """
+        Runs the sweep until the largest voltage update falls below tolerance_kv and returns the number
+        of iterations taken. Raises pandapower's LoadflowNotConverged if max_iterations is exceeded
+        """
+        net = self.net
+
+        loads = net.load[net.load.in_service]
+        s_bus = np.zeros(len(self._bus_lookup), dtype=complex)
+        np.add.at(
+            s_bus,
+            self._bus_lookup.get_indexer(loads.bus.to_numpy()),
+            (loads.p_mw.to_numpy() + 1j * loads.q_mvar.to_numpy()) * loads.scaling.to_numpy(),
+        )
+
+        ext_grid = net.ext_grid.iloc[0]
+        v_slack = ext_grid.vm_pu * self._vn_ph[self._slack] * np.exp(1j * math.radians(ext_grid.va_degree))
+
+        if warm_start and self._v is not None:
+            v = self._v.copy()
+        else:
+            v = ext_grid.vm_pu * self._vn_ph * np.exp(1j * math.radians(ext_grid.va_degree))
+        v[self._slack] = v_slack
+
+        for iteration in range(1, self.max_iterations + 1):
+            i = self._injections(s_bus, v)
+
+            v_next = v.copy()
+            for level in self._levels:
+                v_next[level] = v_next[self._parent[level]] - self._z_branch[level] * i[level]
+
+            delta = np.abs(v_next - v).max()
+            v = v_next
+            if delta < self.tolerance_kv:
+                break
+        else:
+            self._v = None
+            net.converged = False
+            raise pp.LoadflowNotConverged(
+                f"Radial sweep did not converge after {self.max_iterations} iterations"
+            )
+
+        self._v = v
+        self._write_results(s_bus, v, self._injections(s_bus, v))
+        net.converged = True
+        return iteration
+
+    def _write_results(self, s_bus, v, i):
+        net = self.net
+
+        s_ext = 3 * v[self._slack] * np.conj(i[self._slack])
+        s_res = s_bus.copy()
+        s_res[self._slack] -= s_ext
+
+        net.res_bus = pd.DataFrame(
+            {
+                "vm_pu": np.abs(v) / self._vn_ph,
+                "va_degree": np.degrees(np.angle(v)),
+                "p_mw": s_res.real,
+                "q_mvar": s_res.imag,
+            },
+            index=net.bus.index,
+        )
+
+        net.res_ext_grid = pd.DataFrame(
+            {"p_mw": [s_ext.real], "q_mvar": [s_ext.imag]}, index=net.ext_grid.index
+        )
+
+        child = self._line_child
+        parent = self._line_parent
+        i_series = i[child]
+
+        # Current flowing into the line at each terminal
+        i_parent_end = i_series + self._y_half * v[parent]
+        i_child_end = -i_series + self._y_half * v[child]
+
+        flip = self._from_is_parent
+        v_from = np.where(flip, v[parent], v[child])
+        v_to = np.where(flip, v[child], v[parent])
+        i_from = np.where(flip, i_parent_end, i_child_end)
+        i_to = np.where(flip, i_child_end, i_parent_end)
+
+        s_from = 3 * v_from * np.conj(i_from)
+        s_to = 3 * v_to * np.conj(i_to)
+        i_ka = np.maximum(np.abs(i_from), np.abs(i_to))
+
+        vn_from = np.where(flip, self._vn_ph[parent], self._vn_ph[child])
+        vn_to = np.where(flip, self._vn_ph[child], self._vn_ph[parent])
+
+        net.res_line = pd.DataFrame(
+            {
+                "p_from_mw": s_from.real,
+                "q_from_mvar": s_from.imag,
+                "p_to_mw": s_to.real,
+                "q_to_mvar": s_to.imag,
+                "pl_mw": (s_from + s_to).real,
+                "ql_mvar": (s_from + s_to).imag,
+                "i_from_ka": np.abs(i_from),
+                "i_to_ka": np.abs(i_to),
+                "i_ka": i_ka,
+                "vm_from_pu": np.abs(v_from) / vn_from,
+                "va_from_degree": np.degrees(np.angle(v_from)),
+                "vm_to_pu": np.abs(v_to) / vn_to,
+                "va_to_degree": np.degrees(np.angle(v_to)),
+                "loading_percent": i_ka / self._rated_i_ka * 100,
+            },
+            index=self._line_index,
+        )
@@ -0,0 +1,73 @@
+import numpy as np
+import pandas as pd
+
+from learn import _recursive_lag_forecast
+
+
+def stepwise_lag_forecast(history: pd.Series, timestamps, lag: pd.Timedelta) -> pd.Series:
+    """The original one timestamp at a time replay loop, kept as the reference"""
+    preds = []
+    extended_history = history.copy()
+
+    for ts in timestamps:
+        lag_ts = ts - lag
+
+        if lag_ts in extended_history.index:
+            preds.append(extended_history.loc[lag_ts])
+        else:
+            preds.append(extended_history.dropna().iloc[-1])
+
+        extended_history.loc[ts] = preds[-1]
+
+    return pd.Series(preds, index=timestamps)
+
+
+def random_case(rng):
+    # Irregular 15 minute readings with gaps and NaN, forecast over a range that may overlap the end of
+    # the history so predictions also overwrite history entries
+    n_history = int(rng.integers(1, 400))
+    start = pd.Timestamp("2024-09-01")
+    offsets = np.sort(rng.choice(n_history * 2, size=n_history, replace=False))
+    index = start + pd.to_timedelta(offsets * 15, unit="min")
+    values = rng.normal(100, 10, size=n_history)
+    values[rng.random(n_history) < rng.uniform(0, 0.5)] = np.nan
+    values[-1] = 50.0  # Something to fall back on
+
+    if rng.random() < 0.5:
+        values[-int(rng.integers(1, n_history + 1)) :] = np.nan
+        values[int(rng.integers(0, n_history))] = 75.0
+
+    forecast_start = index[-1] - pd.Timedelta(minutes=15 * int(rng.integers(0, 5)))
+    timestamps = pd.date_range(forecast_start, periods=int(rng.integers(1, 300)), freq="15min")
+    lag = pd.Timedelta(minutes=15 * int(rng.choice([1, 4, 16, 96])))
+    return pd.Series(values, index=index), timestamps, lag
+
+
+def test_replay_matches_stepwise_loop_with_nan():
+    rng = np.random.default_rng(0)
+    cases_with_nan = 0
+    for _ in range(300):
+        history, timestamps, lag = random_case(rng)
+        cases_with_nan += history.isna().any()
+
+        expected = stepwise_lag_forecast(history, timestamps, lag)
+        actual = _recursive_lag_forecast(history, timestamps, lag)
+        pd.testing.assert_series_equal(actual, expected, check_dtype=False, check_freq=False)
+
+    assert cases_with_nan >= 150
+
+
+def test_replay_without_fallback_raises():
+    history = pd.Series([np.nan, np.nan], index=pd.date_range("2024-09-01", periods=2, freq="15min"))
+    timestamps = pd.date_range("2024-09-02", periods=3, freq="15min")
+    try:
+        _recursive_lag_forecast(history, timestamps, pd.Timedelta(days=1))
+    except ValueError:
+        return
+    raise AssertionError("Expected a ValueError with no non NaN history to fall back on")
+
+
+if __name__ == "__main__":
+    test_replay_matches_stepwise_loop_with_nan()
+    test_replay_without_fallback_raises()
+    print("Replay matches the step by step loop")